@@ -1,24 +1,40 @@
 # trunk-ignore-all(black)
 import os
+import time
 import secrets
 import logging
 import re
+import threading
 from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 
-import matplotlib
-matplotlib.use('Agg')  # use non-GUI backend for server
-import matplotlib.pyplot as plt
-
-import numpy as np
 import io
+import csv
 import base64
-import random
+import hashlib
+import json
+import tempfile
 import pytz
+import click
 
-from flask import Flask, request, render_template_string, redirect, url_for, session, make_response
+from flask import Flask, Response, g, request, render_template, redirect, url_for, session, make_response, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, update
 from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
+from jinja2 import FileSystemBytecodeCache
+
+from batch import iter_chart_zip
+from cache import LRUCache, TTLCache
+from db_engine import configure_sqlite, engine_options, pool_stats
+from macc_inputs import (FieldError, InputError, macc_analytics, parse_batch, parse_chart_form,
+                         parse_interventions_file, parse_line_value, sort_by_cost)
+from macc_renderer import (CHART_FORMATS, DEFAULT_PROFILE, RENDER_PROFILES, RENDER_VERSION,
+                            canonical_inputs, image_key)
+from metrics import RequestProfiler, metric_lines, request_seconds, span, stage_seconds
+from render_jobs import DONE, FAILED, RenderQueue
+from sessions import MemorySessionStore, RedisSessionStore, SQLSessionStore, ServerSessionInterface
 
 # ---------------------------
 # Helper: IST time & logging
@@ -57,14 +73,32 @@ if not database_url:
     database_url = "sqlite:///" + os.path.join(base_dir, "local_dev.db")
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+
+# Optionally persist compiled template bytecode across restarts/workers
+jinja_bytecode_dir = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+if jinja_bytecode_dir:
+    os.makedirs(jinja_bytecode_dir, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(jinja_bytecode_dir)}
 
 # Security-friendly cookie defaults (can be changed)
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
+
 db = SQLAlchemy(app)
+if database_url.startswith('sqlite'):
+    with app.app_context():
+        configure_sqlite(db.engine)
 migrate = Migrate(app, db)
+# bcrypt cost factor; existing hashes are upgraded/downgraded on the user's next login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
 bcrypt = Bcrypt(app)
+# Hashing runs on a small dedicated pool (bcrypt releases the GIL), which also caps
+# how many CPU cores a login storm can take away from chart rendering.
+password_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('BCRYPT_THREADS', 2)),
+                                   thread_name_prefix='bcrypt')
 
 EMAIL_REGEX = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
 
@@ -75,28 +109,141 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
-    quota = db.Column(db.Integer, nullable=True)
-    approved = db.Column(db.Boolean, default=False)
+    quota = db.Column(db.Integer, nullable=True, index=True)
+    approved = db.Column(db.Boolean, default=False, index=True)
     created_at = db.Column(db.DateTime, default=get_ist_time)
     last_login = db.Column(db.DateTime, nullable=True)
     remember_token = db.Column(db.String(100), unique=True, nullable=True)
 
+    # Supports the admin listing's newest-first keyset pagination
+    __table_args__ = (db.Index('ix_user_created_at_id', 'created_at', 'id'),)
+
     def set_password(self, password):
-        self.password = bcrypt.generate_password_hash(password).decode('utf-8')
+        hashed = password_pool.submit(bcrypt.generate_password_hash, password).result()
+        self.password = hashed.decode('utf-8')
 
     def check_password(self, password):
         try:
-            return bcrypt.check_password_hash(self.password, password)
+            with span('password_check'):
+                return password_pool.submit(bcrypt.check_password_hash, self.password, password).result()
         except Exception as e:
             logging.error(f"Password check failed for {self.email}: {e}")
             return False
 
+    def password_needs_rehash(self):
+        # bcrypt hashes look like $2b$<cost>$<salt+hash>
+        try:
+            return int(self.password.split('$')[2]) != app.config['BCRYPT_LOG_ROUNDS']
+        except (IndexError, ValueError):
+            return False
+
     def __repr__(self):
         return f'<User {self.email}>'
 
-# Create DB tables and default admin for local dev (safe to run repeatedly)
-with app.app_context():
+    @property
+    def metered(self):
+        return self.quota is not None and self.email != 'admin@example.com'
+
+class UsageLedger(db.Model):
+    # Append-only chart usage history: +n when charts are charged, -n when refunded
+    __tablename__ = 'usage_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(40), nullable=False)
+    reference = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, default=get_ist_time, index=True)
+
+    def __repr__(self):
+        return f'<UsageLedger user={self.user_id} amount={self.amount} {self.reason}>'
+
+class SessionRecord(db.Model):
+    # Server-side sessions when SESSION_BACKEND=sql (see sessions.SQLSessionStore)
+    __tablename__ = 'session_store'
+    sid = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# ---------------------------
+# Sessions
+# ---------------------------
+# SESSION_BACKEND picks where session data lives: 'cookie' (Flask's signed cookie,
+# the default), 'memory' (this process only; single worker deployments), 'sql' (the
+# session_store table) or 'redis' (SESSION_REDIS_URL). The server-side backends keep
+# only a random session id in the cookie.
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'cookie')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 7 * 86400))
+
+if SESSION_BACKEND == 'memory':
+    session_store = MemorySessionStore(SESSION_TTL, max_entries=int(os.environ.get('SESSION_CACHE_SIZE', 10000)))
+elif SESSION_BACKEND == 'sql':
+    session_store = SQLSessionStore(lambda: db.engine, SessionRecord.__table__, SESSION_TTL)
+elif SESSION_BACKEND == 'redis':
+    session_store = RedisSessionStore(os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0'), SESSION_TTL)
+elif SESSION_BACKEND == 'cookie':
+    session_store = None
+else:
+    raise RuntimeError(f"Unknown SESSION_BACKEND: {SESSION_BACKEND}")
+if session_store is not None:
+    app.session_interface = ServerSessionInterface(session_store)
+
+# The logged-in user's id, approval and quota ride along in the session, so most
+# requests need no User query. They are re-read at most every SESSION_ACCOUNT_TTL
+# seconds, which bounds how long an admin's approval/quota change takes to show;
+# quota is still charged with a conditional UPDATE, so a stale value can't overspend.
+SESSION_ACCOUNT_TTL = int(os.environ.get('SESSION_ACCOUNT_TTL', 60))
+
+class SessionAccount(namedtuple('SessionAccount', 'id email approved quota last_login')):
+    @property
+    def metered(self):
+        return self.quota is not None and self.email != 'admin@example.com'
+
+def cache_account(user):
+    session['account'] = {'id': user.id, 'approved': bool(user.approved), 'quota': user.quota,
+                          'last_login': user.last_login, 'checked_at': time.time()}
+
+def current_account():
+    """The session's SessionAccount, or None if nobody (or a deleted user) is logged in."""
+    email = session.get('user')
+    if email is None:
+        return None
+    cached = session.get('account')
+    if cached is None or time.time() - cached['checked_at'] > SESSION_ACCOUNT_TTL:
+        user = User.query.filter_by(email=email).first()
+        if user is None:
+            logging.error(f"Session user {email} not found in database")
+            session.clear()
+            return None
+        cache_account(user)
+        cached = session['account']
+    return SessionAccount(cached['id'], email, cached['approved'], cached['quota'], cached['last_login'])
+
+def set_session_quota(quota):
+    session['account'] = {**session['account'], 'quota': quota}
+
+def start_session(user):
+    session.clear()
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+    session['user'] = user.email
+    cache_account(user)
+
+def render_session_key():
+    # Random per login session: render jobs carrying it go to the worker that holds
+    # this session's last figure, so a retitled chart only redraws its overlays
+    if 'render_key' not in session:
+        session['render_key'] = secrets.token_hex(8)
+    return session['render_key']
+
+# ---------------------------
+# Database bootstrap (run once per deploy via `flask bootstrap`, not on import)
+# ---------------------------
+def bootstrap_database():
+    """Create missing tables and indexes and the default admin; safe to run repeatedly."""
     db.create_all()
+    # create_all() skips tables that already exist, so add any newer indexes explicitly
+    for index in User.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
     admin_email = 'admin@example.com'
     if not User.query.filter_by(email=admin_email).first():
         admin = User(
@@ -110,407 +257,259 @@ with app.app_context():
         db.session.commit()
         logging.info("Admin user created (email: admin@example.com, password: password123)")
 
+@app.cli.command("bootstrap")
+def bootstrap_command():
+    """Create tables, indexes and the default admin user."""
+    bootstrap_database()
+    click.echo("Database bootstrapped.")
+
 # ---------------------------
-# Templates (render_template_string)
-# ---------------------------
-AUTH_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-  <title>{{ title }} | MACC Chart Generator</title>
-  <script src="https://cdn.tailwindcss.com"></script>
-  <style>
-    @keyframes fadeIn {
-      from { opacity: 0; transform: translateY(10px); }
-      to { opacity: 1; transform: translateY(0); }
-    }
-    .fade-in {
-      animation: fadeIn 0.5s ease-out;
-    }
-    .hover-scale {
-      transition: transform 0.3s ease;
-    }
-    .hover-scale:hover {
-      transform: scale(1.05);
-    }
-    ::-webkit-scrollbar {
-      width: 6px;
-    }
-    ::-webkit-scrollbar-track {
-      background: #f1f1f1;
-    }
-    ::-webkit-scrollbar-thumb {
-      background: #4b5563;
-      border-radius: 3px;
-    }
-    ::-webkit-scrollbar-thumb:hover {
-      background: #374151;
-    }
-    input, button {
-      -webkit-appearance: none;
-      -moz-appearance: none;
-      appearance: none;
-    }
-    @media (max-width: 640px) {
-      .auth-form {
-        padding: 1rem;
-      }
-      h2 {
-        font-size: 1.5rem;
-      }
-      input, button {
-        font-size: 0.9rem;
-        padding: 0.5rem;
-      }
-    }
-  </style>
-</head>
-<body class="min-h-screen bg-gray-100 flex flex-col">
-  <header class="bg-gradient-to-r from-blue-600 to-indigo-600 text-white shadow-md">
-    <div class="container mx-auto px-4 py-4 text-center">
-      <h1 class="text-xl sm:text-2xl font-bold tracking-tight">MACC Chart Generator</h1>
-    </div>
-  </header>
-  <main class="flex-grow container mx-auto px-4 py-8">
-    <div class="bg-white shadow-lg rounded-xl p-6 fade-in auth-form max-w-md mx-auto w-full">
-      <h2 class="text-xl sm:text-2xl font-semibold text-gray-800 text-center mb-6">{{ title }}</h2>
-      <form method="POST" class="space-y-4">
-        <div>
-          <label for="username" class="block text-sm font-medium text-gray-700">Email</label>
-          <input type="email" name="username" id="username" placeholder="Enter your email" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="password" class="block text-sm font-medium text-gray-700">Password</label>
-          <input type="password" name="password" id="password" placeholder="Enter your password" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="remember" class="flex items-center text-sm font-medium text-gray-700">
-            <input type="checkbox" name="remember" id="remember" class="mr-2" checked> Remember Me
-          </label>
-        </div>
-        <div class="text-center">
-          <button type="submit" class="w-full sm:w-auto px-4 py-2 bg-indigo-600 text-white font-medium rounded-lg shadow-sm hover:bg-indigo-700 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-            {{ title }}
-          </button>
-        </div>
-      </form>
-      <p class="text-center text-red-600 mt-4 text-sm">{{ message }}</p>
-      <p class="text-center text-sm text-gray-600 mt-4">
-        {% if title == "Login" %}
-          Don't have an account? <a href="{{ url_for('register') }}" class="text-indigo-600 hover:underline">Register here</a>
-        {% else %}
-          Already have an account? <a href="{{ url_for('login') }}" class="text-indigo-600 hover:underline">Login here</a>
-        {% endif %}
-      </p>
-    </div>
-  </main>
-  <footer class="bg-gray-800 text-white py-4">
-    <div class="container mx-auto px-4 text-center">
-      <p class="text-xs">© 2025 MACC Chart Generator. All rights reserved.</p>
-    </div>
-  </footer>
-</body>
-</html>
-"""
-
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-  <title>MACC Chart Generator</title>
-  <script src="https://cdn.tailwindcss.com"></script>
-  <style>
-    @keyframes fadeIn {
-      from { opacity: 0; transform: translateY(10px); }
-      to { opacity: 1; transform: translateY(0); }
-    }
-    .fade-in {
-      animation: fadeIn 0.5s ease-out;
-    }
-    .hover-scale {
-      transition: transform 0.3s ease;
-    }
-    .hover-scale:hover {
-      transform: scale(1.05);
-    }
-    ::-webkit-scrollbar {
-      width: 6px;
-    }
-    ::-webkit-scrollbar-track {
-      background: #f1f1f1;
-    }
-    ::-webkit-scrollbar-thumb {
-      background: #4b5563;
-      border-radius: 3px;
-    }
-    ::-webkit-scrollbar-thumb:hover {
-      background: #374151;
-    }
-    .username-display {
-      background: linear-gradient(45deg, #4b5563, #1f2937);
-      color: white;
-      padding: 0.5rem 1rem;
-      border-radius: 8px;
-      font-weight: 600;
-      letter-spacing: 0.05em;
-      box-shadow: 0 2px 4px rgba(0, 0, 0, 0.2);
-      position: absolute;
-      top: 10px;
-      right: 10px;
-      font-size: 0.75rem;
-    }
-    .chart-container img {
-      max-width: 100%;
-      height: auto;
-    }
-    @media (max-width: 640px) {
-      .username-display {
-        top: 60px;
-        right: 10px;
-        font-size: 0.7rem;
-        padding: 0.4rem 0.8rem;
-      }
-      h2 {
-        font-size: 1.5rem;
-      }
-      input, button {
-        font-size: 0.9rem;
-        padding: 0.5rem;
-      }
-      .chart-container {
-        padding: 0.5rem;
-      }
-    }
-    @media (min-width: 641px) and (max-width: 1024px) {
-      .chart-container img {
-        max-height: 400px;
-      }
-    }
-  </style>
-</head>
-<body class="min-h-screen bg-gray-100 flex flex-col">
-  <header class="bg-gradient-to-r from-blue-600 to-indigo-600 text-white shadow-md">
-    <div class="container mx-auto px-4 py-4 flex flex-col sm:flex-row justify-between items-center">
-      <h1 class="text-xl sm:text-2xl font-bold tracking-tight text-center sm:text-left">MACC Chart Generator</h1>
-      <form method="POST" action="{{ url_for('logout') }}" class="mt-2 sm:mt-0">
-        <button type="submit" class="w-full sm:w-auto bg-red-500 hover:bg-red-600 text-white font-medium py-2 px-4 rounded-lg transition duration-300 hover-scale text-sm">
-          Logout
-        </button>
-      </form>
-    </div>
-  </header>
-  <main class="flex-grow container mx-auto px-4 py-8 relative">
-    <div class="username-display">
-      UserId: {{ session['user'] }}
-    </div>
-    <div class="bg-white shadow-lg rounded-xl p-6 fade-in mt-12">
-      <h2 class="text-xl sm:text-2xl font-semibold text-gray-800 text-center mb-6">Generate Chart</h2>
-      <form method="POST" class="space-y-4">
-        <div>
-          <label for="project_name" class="block text-sm font-medium text-gray-700">Organisation Name</label>
-          <input type="text" name="project_name" id="project_name" placeholder="Enter Organisation Name" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="categories" class="block text-sm font-medium text-gray-700">Interventions/Projects (comma-separated)</label>
-          <input type="text" name="categories" id="categories" placeholder="Enter Interventions/Projects" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="values" class="block text-sm font-medium text-gray-700">MACC Value In USD/Ton CO2 (comma-separated)</label>
-          <input type="text" name="values" id="values" placeholder="Enter MACC Values" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="widths" class="block text-sm font-medium text-gray-700">CO2 Abatement Value (Million Ton) (comma-separated)</label>
-          <input type="text" name="widths" id="widths" placeholder="Enter CO2 Abatement Values" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="line_value" class="block text-sm font-medium text-gray-700">Internal Carbon Price in USD/Ton CO2 (optional)</label>
-          <input type="number" name="line_value" id="line_value" placeholder="Enter Internal Carbon Price"
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div class="text-center">
-          <button type="submit" class="w-full sm:w-auto px-4 py-2 bg-indigo-600 text-white font-medium rounded-lg shadow-sm hover:bg-indigo-700 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-            Generate Chart
-          </button>
-        </div>
-      </form>
-      {% if chart %}
-        <div class="mt-8 chart-container">
-          <h3 class="text-lg font-semibold text-gray-800 text-center mb-4">Generated Chart</h3>
-          <div class="bg-gray-50 p-4 rounded-lg shadow-inner max-w-6xl mx-auto">
-            <img src="data:image/png;base64,{{ chart }}" alt="MACC Chart" class="w-full h-auto mx-auto rounded-lg shadow-md hover-scale">
-          </div>
-        </div>
-      {% endif %}
-      {% if session['user'] == 'admin@example.com' %}
-        <div class="mt-6 text-center">
-          <a href="{{ url_for('admin') }}" class="inline-flex items-center px-4 py-2 bg-blue-600 text-white font-medium rounded-lg shadow-sm hover:bg-blue-700 focus:outline-none focus:ring-2 focus:ring-blue-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-            Go to Admin Panel
-          </a>
-        </div>
-      {% endif %}
-    </div>
-  </main>
-  <footer class="bg-gray-800 text-white py-4">
-    <div class="container mx-auto px-4 text-center">
-      <p class="text-xs">© 2025 MACC Chart Generator. All rights reserved.</p>
-    </div>
-  </footer>
-</body>
-</html>
-"""
-
-ADMIN_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-  <title>Admin Panel | MACC Chart Generator</title>
-  <script src="https://cdn.tailwindcss.com"></script>
-  <style>
-    @keyframes fadeIn {
-      from { opacity: 0; transform: translateY(10px); }
-      to { opacity: 1; transform: translateY(0); }
-    }
-    .fade-in {
-      animation: fadeIn 0.5s ease-out;
-    }
-    .hover-scale {
-      transition: transform 0.3s ease;
-    }
-    .hover-scale:hover {
-      transform: scale(1.05);
-    }
-    ::-webkit-scrollbar {
-      width: 6px;
-    }
-    ::-webkit-scrollbar-track {
-      background: #f1f1f1;
-    }
-    ::-webkit-scrollbar-thumb {
-      background: #4b5563;
-      border-radius: 3px;
-    }
-    ::-webkit-scrollbar-thumb:hover {
-      background: #374151;
-    }
-    input, button {
-      -webkit-appearance: none;
-      -moz-appearance: none;
-      appearance: none;
-    }
-    @media (max-width: 640px) {
-      h2 {
-        font-size: 1.5rem;
-      }
-      input, button {
-        font-size: 0.9rem;
-        padding: 0.5rem;
-      }
-      .user-list li {
-        font-size: 0.9rem;
-        padding: 0.5rem;
-      }
+# Templates (templates/*.html, compiled once at startup)
+# ---------------------------
+def precompile_templates():
+    # Flask's Jinja environment caches compiled templates, so loading them all here
+    # means requests only pay for rendering, never for parsing/compiling.
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+# ---------------------------
+# Chart rendering + content-addressed cache
+# ---------------------------
+# Entries are keyed by a content hash that doubles as the public chart id. Each entry
+# keeps the parsed inputs so other formats and render profiles can be rendered on
+# demand from /chart/<id>.<fmt>?profile=<name>; files are stored under image_key().
+# A print PNG can be several MB, so the cache is also bounded by the total size of
+# the files it holds (CHART_CACHE_BYTES per web process).
+def chart_entry_bytes(entry):
+    return sum(len(image) for image in entry['images'].values())
+
+chart_cache = LRUCache(
+    max_entries=int(os.environ.get('CHART_CACHE_SIZE', 256)),
+    max_bytes=int(os.environ.get('CHART_CACHE_BYTES', 128 * 1024 * 1024)),
+    sizeof=chart_entry_bytes,
+)
+chart_cache_lock = threading.RLock()  # serialises get-or-create of entries across threads
+CHART_MAX_AGE = int(os.environ.get('CHART_MAX_AGE', 86400))
+
+def chart_cache_key(project_name, categories, values, widths, line_value):
+    payload = {
+        'v': RENDER_VERSION,
+        'title': project_name,
+        'data': canonical_inputs(categories, values, widths),
+        'line': None if line_value is None else float(line_value),
     }
-  </style>
-</head>
-<body class="min-h-screen bg-gray-100 flex flex-col">
-  <header class="bg-gradient-to-r from-blue-600 to-indigo-600 text-white shadow-md">
-    <div class="container mx-auto px-4 py-4 flex flex-col sm:flex-row justify-between items-center">
-      <h1 class="text-xl sm:text-2xl font-bold tracking-tight text-center sm:text-left">MACC Chart Generator and Calculator</h1>
-      <form method="POST" action="{{ url_for('logout') }}" class="mt-2 sm:mt-0">
-        <button type="submit" class="w-full sm:w-auto bg-red-500 hover:bg-red-600 text-white font-medium py-2 px-4 rounded-lg transition duration-300 hover-scale text-sm">
-          Logout
-        </button>
-      </form>
-    </div>
-  </header>
-  <main class="flex-grow container mx-auto px-4 py-8">
-    <div class="bg-white shadow-lg rounded-xl p-6 fade-in w-full max-w-2xl mx-auto">
-      <h2 class="text-xl sm:text-2xl font-semibold text-gray-800 text-center mb-6">Admin Panel</h2>
-      <form method="POST" class="space-y-4">
-        <div>
-          <label for="username" class="block text-sm font-medium text-gray-700">User Email</label>
-          <input type="email" name="username" id="username" placeholder="Enter user email" required
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div>
-          <label for="quota" class="block text-sm font-medium text-gray-700">New Quota (optional)</label>
-          <input type="number" name="quota" id="quota" placeholder="Enter new quota"
-                 class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-500 focus:ring-indigo-500 text-sm p-3">
-        </div>
-        <div class="flex flex-col sm:flex-row justify-center gap-3">
-          <button type="submit" class="w-full sm:w-auto px-4 py-2 bg-indigo-600 text-white font-medium rounded-lg shadow-sm hover:bg-indigo-700 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-            Update Quota
-          </button>
-          <button type="submit" name="approve" class="w-full sm:w-auto px-4 py-2 bg-green-600 text-white font-medium rounded-lg shadow-sm hover:bg-green-700 focus:outline-none focus:ring-2 focus:ring-green-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-            Approve User
-          </button>
-          <button type="submit" name="reset_password" class="w-full sm:w-auto px-4 py-2 bg-yellow-600 text-white font-medium rounded-lg shadow-sm hover:bg-yellow-700 focus:outline-none focus:ring-2 focus:ring-yellow-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-            Reset Password
-          </button>
-        </div>
-      </form>
-      <p class="text-center text-green-600 mt-4 text-sm font-semibold">{{ message }}</p>
-      <h3 class="text-lg font-semibold text-gray-800 text-center mt-6 mb-4">Current Users</h3>
-      <ul class="space-y-2 user-list">
-        {% for user in users %}
-          <li class="bg-gray-50 p-3 rounded-lg shadow-sm text-sm">
-            <span class="font-medium">{{ user.email }}</span> - 
-            Quota: {{ user.quota if user.quota is not none else "Unlimited" }} - 
-            Approved: {{ "Yes" if user.approved else "No" }}
-          </li>
-        {% endfor %}
-      </ul>
-      <div class="text-center mt-6">
-        <a href="{{ url_for('index') }}" class="inline-flex items-center px-4 py-2 bg-blue-600 text-white font-medium rounded-lg shadow-sm hover:bg-blue-700 focus:outline-none focus:ring-2 focus:ring-blue-500 focus:ring-offset-2 transition duration-300 hover-scale text-sm">
-          Back to Main App
-        </a>
-      </div>
-    </div>
-  </main>
-  <footer class="bg-gray-800 text-white py-4">
-    <div class="container mx-auto px-4 text-center">
-      <p class="text-xs">© 2025 MACC Chart Generator. All rights reserved.</p>
-    </div>
-  </footer>
-</body>
-</html>
-"""
+    encoded = json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+# ---------------------------
+# Background render queue
+# ---------------------------
+render_queue = RenderQueue(
+    max_workers=int(os.environ.get('RENDER_WORKERS', 0)) or None,
+    max_jobs=int(os.environ.get('RENDER_JOB_HISTORY', 1024)),
+    max_tasks_per_worker=int(os.environ.get('RENDER_WORKER_MAX_TASKS', 200)),
+    stall_timeout=int(os.environ.get('RENDER_STALL_TIMEOUT', 300)),
+)
+
+# Quota changes are single conditional UPDATEs, so concurrent requests from one user
+# can never overspend and the User row is only locked for that one statement.
+def reserve_quota(user, count=1, reason='chart', reference=None):
+    """Charge ``count`` charts up front; returns False if the quota can't cover them."""
+    try:
+        if user.metered:
+            result = db.session.execute(
+                update(User)
+                .where(User.id == user.id, User.quota >= count)
+                .values(quota=User.quota - count)
+            )
+            if result.rowcount != 1:
+                db.session.rollback()
+                logging.info(f"Quota exhausted for {user.email}: {count} chart(s) requested")
+                return False
+        db.session.add(UsageLedger(user_id=user.id, amount=count, reason=reason, reference=reference))
+        db.session.commit()
+        logging.info(f"Quota charged {count} for {user.email} ({reason})")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to charge quota for {user.email}: {e}")
+        db.session.rollback()
+        raise
+
+def refund_quota(user_id, count=1, reason='refund', reference=None):
+    try:
+        db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.quota.isnot(None), User.email != 'admin@example.com')
+            .values(quota=User.quota + count)
+        )
+        db.session.add(UsageLedger(user_id=user_id, amount=-count, reason=reason, reference=reference))
+        db.session.commit()
+        logging.info(f"Quota refunded {count} for user {user_id} ({reason})")
+    except Exception as e:
+        logging.error(f"Failed to refund {count} chart(s) for user {user_id}: {e}")
+        db.session.rollback()
+
+def chart_entry(chart_id, spec):
+    # The cached entry for chart_id, created (empty) if there isn't one
+    with chart_cache_lock:
+        entry = chart_cache.get(chart_id)
+        if entry is None:
+            entry = {'spec': spec, 'images': {}}
+            chart_cache.put(chart_id, entry)
+        return entry
+
+def store_chart_image(chart_id, spec, key, image):
+    """Add ``image`` to the chart's cache entry, keeping the files already there."""
+    with chart_cache_lock:
+        entry = chart_entry(chart_id, spec)
+        entry['images'][key] = image
+        chart_cache.put(chart_id, entry)  # re-counts the entry's size against the byte budget
+    return entry
+
+def _chart_job_done(job, image):
+    # Runs in the render pool's callback thread, outside any request
+    store_chart_image(job['chart_id'], job['spec'], image_key(job['fmt'], job['profile']), image)
+
+def _chart_job_failed(job, error):
+    with app.app_context():
+        refund_quota(job['user_id'], reason='render failed', reference=job['chart_id'])
+
+# Other formats and profiles of a cached chart are rendered when first requested,
+# in the render pool like everything else. Concurrent requests for the same file
+# share one job: (chart id, image key) -> the job rendering it.
+on_demand_jobs = LRUCache(max_entries=int(os.environ.get('RENDER_JOB_HISTORY', 1024)))
+on_demand_lock = threading.Lock()
+CHART_RENDER_TIMEOUT = int(os.environ.get('CHART_RENDER_TIMEOUT', 120))
+# On-demand renders aren't charged (the chart already was), so cap how many new
+# ones each user can have running at once; print PNGs can take seconds each
+ON_DEMAND_RENDERS_PER_USER = int(os.environ.get('ON_DEMAND_RENDERS_PER_USER', 2))
+on_demand_running = {}  # owner -> on-demand jobs started and not finished
+
+def _on_demand_finished(owner):
+    with on_demand_lock:
+        remaining = on_demand_running.get(owner, 0) - 1
+        if remaining > 0:
+            on_demand_running[owner] = remaining
+        else:
+            on_demand_running.pop(owner, None)
+
+def render_on_demand(chart_id, entry, fmt, profile, owner):
+    """The job rendering ``fmt`` at ``profile`` for a cached chart, joining one
+    that is already running for the same file. Returns None if ``owner`` already
+    has ON_DEMAND_RENDERS_PER_USER renders of their own running."""
+    key = (chart_id, image_key(fmt, profile))
+    with on_demand_lock:
+        job = on_demand_jobs.get(key)
+        if job is not None and not job['future'].done():
+            return job
+        if on_demand_running.get(owner, 0) >= ON_DEMAND_RENDERS_PER_USER:
+            return None
+        job = render_queue.submit(owner, entry['spec'], fmt=fmt, profile=profile, on_success=_chart_job_done,
+                                  chart_id=chart_id)
+        on_demand_running[owner] = on_demand_running.get(owner, 0) + 1
+        on_demand_jobs.put(key, job)
+    # Outside the lock: on an already finished future the callback runs right here
+    job['future'].add_done_callback(lambda _: _on_demand_finished(owner))
+    return job
+
+def job_payload(job):
+    status = render_queue.status(job)
+    payload = {'id': job['id'], 'status': status, 'error': job['error']}
+    if status == DONE:
+        payload['chart_id'] = job['chart_id']
+        payload['url'] = url_for('chart_image', chart_id=job['chart_id'], fmt=job['fmt'],
+                                 profile=None if job['profile'] == DEFAULT_PROFILE else job['profile'])
+        payload['png_url'] = url_for('chart_image', chart_id=job['chart_id'], fmt='png')
+        payload['print_png_url'] = url_for('chart_image', chart_id=job['chart_id'], fmt='png', profile='print')
+        payload['svg_url'] = url_for('chart_image', chart_id=job['chart_id'], fmt='svg')
+        payload['pdf_url'] = url_for('chart_image', chart_id=job['chart_id'], fmt='pdf')
+    return payload
 
 # ---------------------------
 # Before request: remember-me auto login
 # ---------------------------
+# Token -> (user id, email, approved), or False for unknown tokens, so clients with a
+# remember_token cookie don't cost a query per request. Entries are dropped on logout,
+# password reset and approval; other workers see those changes once the TTL lapses.
+remember_cache = TTLCache(
+    max_entries=int(os.environ.get('REMEMBER_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('REMEMBER_CACHE_TTL', 300)),
+)
+# last_login is written at most once per interval per user
+LAST_LOGIN_WRITE_INTERVAL = int(os.environ.get('LAST_LOGIN_WRITE_INTERVAL', 600))
+last_login_writes = TTLCache(max_entries=int(os.environ.get('REMEMBER_CACHE_SIZE', 10000)),
+                             ttl=LAST_LOGIN_WRITE_INTERVAL)
+
+def forget_remember_token(token):
+    if token:
+        remember_cache.pop(token)
+
+def touch_last_login(user_id, email):
+    if last_login_writes.get(user_id):
+        return
+    last_login_writes.put(user_id, True)
+    now = get_ist_time()
+    try:
+        User.query.filter_by(id=user_id).update({User.last_login: now})
+        db.session.commit()
+        logging.info(f"Auto-login successful for {email} at {now.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+    except Exception as e:
+        logging.error(f"Failed to update last_login for {email}: {e}")
+        db.session.rollback()
+
 @app.before_request
 def auto_login():
     if 'user' not in session and 'remember_token' in request.cookies:
         token = request.cookies.get('remember_token')
-        logging.debug(f"Checking remember_token: {token}")
-        user = User.query.filter_by(remember_token=token).first()
-        if user:
-            if user.approved:
-                session['user'] = user.email
-                user.last_login = get_ist_time()
-                try:
-                    db.session.commit()
-                    logging.info(f"Auto-login successful for {user.email} at {user.last_login.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-                except Exception as e:
-                    logging.error(f"Failed to update last_login for {user.email}: {e}")
-                    db.session.rollback()
+        cached = remember_cache.get(token)
+        if cached is None:
+            user = User.query.filter_by(remember_token=token).first()
+            cached = (user.id, user.email, user.approved) if user else False
+            remember_cache.put(token, cached)
+        if cached:
+            user_id, email, approved = cached
+            if approved:
+                session['user'] = email
+                touch_last_login(user_id, email)
             else:
-                logging.warning(f"Auto-login failed for {user.email}: not approved")
+                logging.warning(f"Auto-login failed for {email}: not approved")
         else:
-            logging.warning(f"Auto-login failed: invalid remember_token {token}")
+            logging.warning("Auto-login failed: invalid remember_token")
+
+# ---------------------------
+# Instrumentation: request timing and on-demand profiles
+# ---------------------------
+# An admin can profile a single request by sending the PROFILE_HEADER header
+# ("cprofile", or "pyinstrument" if it is installed); the profile is written to
+# PROFILE_DIR and its path returned in the X-Profile-File response header.
+PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Profile')
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'macc-profiles')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    kind = request.headers.get(PROFILE_HEADER)
+    if kind and session.get("user") == "admin@example.com":
+        try:
+            profiler = RequestProfiler(PROFILE_DIR, kind='pyinstrument' if kind == 'pyinstrument' else 'cprofile')
+            profiler.start()
+        except Exception as e:
+            # e.g. pyinstrument missing, or another profiler already running
+            logging.warning(f"Request profile not taken: {e}")
+        else:
+            g.profiler = profiler
+
+@app.after_request
+def finish_request_timer(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        path = profiler.stop(request.endpoint or 'request')
+        response.headers['X-Profile-File'] = path
+        logging.info(f"Request profile for {request.path} written to {path}")
+    started = g.get('request_started')
+    if started is not None:
+        request_seconds.observe(request.endpoint or 'unmatched', time.perf_counter() - started)
+    return response
 
 # ---------------------------
 # Routes: login / register
@@ -524,24 +523,29 @@ def login():
         logging.debug(f"Login attempt for {username}, remember={remember}")
         if not re.match(EMAIL_REGEX, username):
             logging.error(f"Invalid email format: {username}")
-            return render_template_string(AUTH_TEMPLATE, title="Login", message="Username must be a valid email address.")
+            return render_template("auth.html", title="Login", message="Username must be a valid email address.")
         
         user = User.query.filter_by(email=username).first()
         if user and user.check_password(password):
             if not user.approved:
                 logging.warning(f"Login failed for {username}: awaiting approval")
-                return render_template_string(AUTH_TEMPLATE, title="Login", message="Awaiting admin approval.")
-            session["user"] = username
+                return render_template("auth.html", title="Login", message="Awaiting admin approval.")
+            if user.password_needs_rehash():
+                user.set_password(password)
+                logging.info(f"Password rehashed for {username} with cost {app.config['BCRYPT_LOG_ROUNDS']}")
             user.last_login = get_ist_time()
+            last_login_writes.put(user.id, True)
             try:
                 db.session.commit()
                 logging.info(f"User {username} logged in at {user.last_login.strftime('%Y-%m-%d %H:%M:%S %Z')}")
             except Exception as e:
                 logging.error(f"Failed to update last_login for {username}: {e}")
                 db.session.rollback()
-                return render_template_string(AUTH_TEMPLATE, title="Login", message="Internal server error.")
+                return render_template("auth.html", title="Login", message="Internal server error.")
+            start_session(user)
             if remember:
                 token = secrets.token_urlsafe(32)
+                forget_remember_token(user.remember_token)
                 user.remember_token = token
                 try:
                     db.session.commit()
@@ -549,15 +553,15 @@ def login():
                 except Exception as e:
                     logging.error(f"Failed to save remember token for {username}: {e}")
                     db.session.rollback()
-                    return render_template_string(AUTH_TEMPLATE, title="Login", message="Internal server error.")
+                    return render_template("auth.html", title="Login", message="Internal server error.")
                 response = make_response(redirect(url_for("index")))
                 response.set_cookie('remember_token', token, max_age=31536000, httponly=True, samesite='Lax')
                 logging.debug(f"Cookie set for {username} with max_age=31536000")
                 return response
             return redirect(url_for("index"))
         logging.warning(f"Login failed for {username}: invalid credentials")
-        return render_template_string(AUTH_TEMPLATE, title="Login", message="Invalid credentials.")
-    return render_template_string(AUTH_TEMPLATE, title="Login", message="")
+        return render_template("auth.html", title="Login", message="Invalid credentials.")
+    return render_template("auth.html", title="Login", message="")
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -567,11 +571,11 @@ def register():
         logging.debug(f"Registration attempt for {username}")
         if not re.match(EMAIL_REGEX, username):
             logging.error(f"Invalid email format for registration: {username}")
-            return render_template_string(AUTH_TEMPLATE, title="Register", message="Username must be a valid email address.")
+            return render_template("auth.html", title="Register", message="Username must be a valid email address.")
         
         if User.query.filter_by(email=username).first():
             logging.warning(f"Registration failed: {username} already exists")
-            return render_template_string(AUTH_TEMPLATE, title="Register", message="User already exists.")
+            return render_template("auth.html", title="Register", message="User already exists.")
         
         new_user = User(email=username, quota=3, approved=False)
         new_user.set_password(password)
@@ -579,12 +583,12 @@ def register():
             db.session.add(new_user)
             db.session.commit()
             logging.info(f"User registered: {username}")
-            return render_template_string(AUTH_TEMPLATE, title="Login", message="Registered. Awaiting admin approval.")
+            return render_template("auth.html", title="Login", message="Registered. Awaiting admin approval.")
         except Exception as e:
             logging.error(f"Registration failed for {username}: {e}")
             db.session.rollback()
-            return render_template_string(AUTH_TEMPLATE, title="Register", message="Internal server error.")
-    return render_template_string(AUTH_TEMPLATE, title="Register", message="")
+            return render_template("auth.html", title="Register", message="Internal server error.")
+    return render_template("auth.html", title="Register", message="")
 
 # ---------------------------
 # Logout
@@ -594,6 +598,7 @@ def logout():
     if 'user' in session:
         user = User.query.filter_by(email=session['user']).first()
         if user:
+            forget_remember_token(user.remember_token)
             user.remember_token = None
             try:
                 db.session.commit()
@@ -601,7 +606,8 @@ def logout():
             except Exception as e:
                 logging.error(f"Failed to clear remember token for {user.email}: {e}")
                 db.session.rollback()
-    session.pop("user", None)
+    session.clear()
+    forget_remember_token(request.cookies.get('remember_token'))
     response = make_response(redirect(url_for("login")))
     response.delete_cookie('remember_token')
     logging.info("User logged out")
@@ -616,10 +622,8 @@ def index():
         logging.debug("No user in session, redirecting to login")
         return redirect(url_for("login"))
 
-    user = User.query.filter_by(email=session["user"]).first()
-    if not user:
-        logging.error(f"Session user {session['user']} not found in database")
-        session.pop("user", None)
+    user = current_account()
+    if user is None:
         return redirect(url_for("login"))
     if not user.approved:
         logging.warning(f"Access denied for {user.email}: not approved")
@@ -627,92 +631,26 @@ def index():
 
     if user.quota is not None and user.quota <= 0:
         logging.info(f"Quota reached for {user.email}")
-        return render_template_string("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-  <title>Limit Reached</title>
-  <style>
-    body {
-      font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-      background-color: #f8f9fa;
-      margin: 0;
-      display: flex;
-      justify-content: center;
-      align-items: center;
-      min-height: 100vh;
-      overflow: hidden;
-    }
-    .card {
-      background: white;
-      padding: 1.5rem;
-      border-radius: 10px;
-      box-shadow: 0 4px 12px rgba(0,0,0,0.1);
-      max-width: 90%;
-      width: 100%;
-      text-align: center;
-    }
-    h2 {
-      color: #dc3545;
-      margin-bottom: 0.75rem;
-      font-size: 1.5rem;
-    }
-    p {
-      color: #555;
-      margin-bottom: 1rem;
-      font-size: 0.9rem;
-    }
-    .logout-button {
-      background-color: #dc3545;
-      color: white;
-      padding: 8px 12px;
-      border: none;
-      border-radius: 5px;
-      cursor: pointer;
-      font-size: 0.9rem;
-    }
-    .logout-button:hover {
-      background-color: #c82333;
-    }
-    @media (max-width: 640px) {
-      .card {
-        padding: 1rem;
-      }
-      h2 {
-        font-size: 1.2rem;
-      }
-      p, .logout-button {
-        font-size: 0.8rem;
-      }
-    }
-  </style>
-</head>
-<body>
-  <div class="card">
-    <h2>Usage Limit Reached</h2>
-    <p>Your chart generation limit has been reached.</p>
-    <p>Please contact the admin to request additional access.</p>
-    <form method="POST" action="{{ url_for('logout') }}">
-      <button type="submit" class="logout-button">Logout</button>
-    </form>
-  </div>
-</body>
-</html>
-""")
+        return render_template("quota_exhausted.html")
 
     chart = None
+    job_id = None
+    fmt = 'png'
     if request.method == "POST":
         try:
             project_name = request.form.get("project_name", "").strip()
-            categories = [c.strip() for c in request.form.get("categories", "").split(",") if c.strip() != ""]
-            values = [float(v.strip()) for v in request.form.get("values", "").split(",") if v.strip() != ""]
-            widths = [float(w.strip()) for w in request.form.get("widths", "").split(",") if w.strip() != ""]
-            line_value = request.form.get("line_value", None)
-            line_value = float(line_value) if line_value not in (None, "", "None") else None
-
-            if not (categories and values and widths):
+            upload = request.files.get("interventions_file")
+            try:
+                with span('parse'):
+                    if upload and upload.filename:
+                        categories, values, widths = parse_interventions_file(upload.stream, upload.filename)
+                        line_value = parse_line_value(request.form.get("line_value"))
+                    else:
+                        categories, values, widths, line_value = parse_chart_form(request.form)
+            except InputError as e:
+                logging.error(f"Input rejected for {user.email}: {e}")
+                return f"Error: {e}"
+            if not (len(categories) and len(values) and len(widths)):
                 logging.error("Empty inputs on chart generation")
                 return "Error: Inputs cannot be empty."
 
@@ -720,91 +658,263 @@ def index():
                 logging.error(f"Input mismatch for {user.email}: categories={len(categories)}, values={len(values)}, widths={len(widths)}")
                 return "Error: Mismatched lengths of inputs."
 
-            y_max = max(values) if values else 0
-            y_min = min(values) if values else 0
-            y_abs_max = max([abs(v) for v in values]) if values else 0
-            small_offset = y_abs_max * 0.05 if y_abs_max > 0 else 1
-            small_text = y_abs_max * 0.02 if y_abs_max > 0 else 1
-            label_y = y_min - small_offset if y_min < 0 else -small_offset
-            line_end_y = label_y + small_offset * 0.4
-            total_y = label_y - small_offset * 0.5
-
-            total_abatement = sum(widths)
-            x_positions = np.cumsum([0] + widths[:-1])
-            colors = ["#" + ''.join(random.choices('0123456789ABCDEF', k=6)) for _ in categories]
-
-            # Responsive chart size based on data range
-            fig_width = max(10, min(35, len(categories) * 2))  # Adjust width based on number of categories
-            fig_height = 15
-            plt.figure(figsize=(fig_width, fig_height))
-
-            plt.bar(x_positions, values, width=widths, color=colors, edgecolor='black', align='edge')
-
-            # Add value labels: aligned directly on x-axis with 0.1 gap for positive
-            for x, y, w in zip(x_positions, values, widths):
-                if y >= 0:
-                    text_y = 0.9 # 0.1 gap above x-axis
-                    plt.text(x + w / 2, text_y, f"{y}", ha='center', va='bottom', rotation=90, fontsize=12)
-                else:
-                    text_y = 0  # Directly on x-axis, below
-                    plt.text(x + w / 2, text_y, f"{y}", ha='center', va='top', rotation=90, fontsize=12)
+            if "sort_by_cost" in request.form:
+                categories, values, widths = sort_by_cost(categories, values, widths)
 
-            # Add vertical lines below x-axis numbers
-            for x, y, w in zip(x_positions, values, widths):
-                if y >= 0:
-                    line_start_y = 0
-                else:
-                    line_start_y = y
-                plt.vlines(x + w / 2, line_start_y, line_end_y, colors='black', linestyles='dashed', linewidth=1)
-
-            plt.xticks(x_positions + np.array(widths) / 2, categories, ha="center", rotation=90, fontsize=12)
-            plt.title(f"Marginal Abatement Cost Curve (MACC) - {project_name}", fontsize=18)
-            plt.xlabel("CO2 Abatement, Million Tonne", fontsize=14)
-            plt.ylabel("MACC Values USD/Ton CO2", fontsize=14)
-
-            # Add CO2 abatement values below the lines, moved up slightly
-            for i, (x, width) in enumerate(zip(x_positions, widths)):
-                stagger = (i % 2) * small_offset * 0.5  # Alternate offset for even/odd indices
-                new_y = line_end_y - (small_offset * 0.5) - (stagger * 0.5)
-                plt.text(x + width / 2, new_y, f"{int(width)}", ha="center", rotation=90, fontsize=12)
-
-            # Add internal carbon price line if provided
-            if line_value is not None:
-                plt.axhline(y=line_value, color='red', linestyle='--', linewidth=2)
-                plt.text(x_positions[0] - 0.2, line_value + (max(values)*0.02 if max(values)>0 else 1),
-                         f"Internal carbon price {line_value}", color='black', fontsize=12, ha='left')
-
-            plt.tick_params(axis='y', labelsize=12)
-            plt.ylim(y_min - small_offset * 2, y_max + small_offset)
-            plt.subplots_adjust(bottom=0.45, right=0.95)
-
-            # Add total abatement text, shifted right
-            last_x = x_positions[-1] + widths[-1]
-            plt.text(last_x + small_offset, total_y, f"Total: {total_abatement:.1f}", ha='left', fontsize=12, color="black")
-
-            # Save chart to buffer
-            buf = io.BytesIO()
-            plt.savefig(buf, format="png", bbox_inches='tight', dpi=150)
-            buf.seek(0)
-            chart = base64.b64encode(buf.getvalue()).decode("utf-8")
-            buf.close()
-            plt.close()
-
-            if user.quota is not None and user.email != 'admin@example.com':
-                user.quota = max(0, user.quota - 1)
+            fmt = request.form.get("format", "png")
+            if fmt not in CHART_FORMATS:
+                return f"Error: Unsupported format {fmt}."
+
+            chart_id = chart_cache_key(project_name, categories, values, widths, line_value)
+            # Reserve before rendering; a failed render is refunded, so only
+            # successful charts end up consuming quota
+            with span('quota'):
+                reserved = reserve_quota(user, reason='chart', reference=chart_id)
+            if not reserved:
+                set_session_quota(0)
+                return render_template("quota_exhausted.html")
+            if user.metered:
+                set_session_quota(user.quota - 1)
+            entry = chart_cache.get(chart_id)
+            spec = (project_name, categories, values, widths, line_value)
+            if entry is not None and image_key(fmt) in entry['images']:
+                chart = chart_id
+                logging.debug(f"Chart {chart_id} served from cache for {user.email}")
+            else:
+                # Every format renders in the pool; the charge is refunded if it fails
                 try:
-                    db.session.commit()
-                    logging.info(f"Quota decremented for {user.email}: new quota={user.quota}")
-                except Exception as e:
-                    logging.error(f"Failed to decrement quota for {user.email}: {e}")
-                    db.session.rollback()
+                    with span('enqueue'):
+                        job = render_queue.submit(user.email, spec, fmt=fmt, on_success=_chart_job_done,
+                                                  on_failure=_chart_job_failed, session_key=render_session_key(),
+                                                  chart_id=chart_id, user_id=user.id)
+                except Exception:
+                    refund_quota(user.id, reason='render failed', reference=chart_id)
+                    raise
+                job_id = job['id']
+                logging.info(f"Render job {job_id} queued for {user.email}")
 
         except Exception as e:
             logging.error(f"Chart generation failed for {user.email}: {e}")
             return f"Error processing your input: {e}"
 
     logging.debug(f"Rendering index page for {user.email}")
-    return render_template_string(HTML_TEMPLATE, chart=chart, last_login=user.last_login)
+    with span('template'):
+        return render_template("index.html", chart=chart, chart_fmt=fmt if chart or job_id else 'png', job_id=job_id,
+                               last_login=user.last_login)
+
+# ---------------------------
+# Render job status / result
+# ---------------------------
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    if "user" not in session:
+        return jsonify(error="Not logged in."), 401
+    job = render_queue.jobs.get(job_id)
+    if job is None or job['owner'] != session["user"]:
+        return jsonify(error="Job not found."), 404
+    return jsonify(job_payload(job))
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    if "user" not in session:
+        return redirect(url_for("login"))
+    job = render_queue.jobs.get(job_id)
+    if job is None or job['owner'] != session["user"]:
+        return jsonify(error="Job not found."), 404
+    payload = job_payload(job)
+    if payload['status'] == DONE:
+        return redirect(payload['url'])
+    if payload['status'] == FAILED:
+        return jsonify(payload), 500
+    return jsonify(payload), 202
+
+# ---------------------------
+# Chart images (served by URL so browsers can cache them)
+# ---------------------------
+@app.route("/chart/<chart_id>.<any(png, svg, pdf):fmt>", methods=["GET"])
+def chart_image(chart_id, fmt):
+    if "user" not in session:
+        return redirect(url_for("login"))
+
+    profile = request.args.get("profile", DEFAULT_PROFILE)
+    if profile not in RENDER_PROFILES:
+        return f"Unknown render profile {profile}.", 404
+    key = image_key(fmt, profile)
+
+    # The id is a content hash, so an ETag match means the bytes cannot have changed
+    if request.if_none_match.contains(f"{chart_id}.{key}"):
+        response = make_response("", 304)
+    else:
+        entry = chart_cache.get(chart_id)
+        if entry is None:
+            logging.info(f"Chart {chart_id} requested but no longer cached")
+            return "Chart expired. Please generate it again.", 404
+        image = entry['images'].get(key)
+        if image is None:
+            job = render_on_demand(chart_id, entry, fmt, profile, session["user"])
+            if job is None:
+                logging.info(f"On-demand render of {key} for {session['user']} throttled")
+                response = make_response("Too many charts rendering, please retry shortly.", 429)
+                response.headers['Retry-After'] = '5'
+                return response
+            try:
+                with span('render_wait'):
+                    image, _ = job['future'].result(timeout=CHART_RENDER_TIMEOUT)
+            except FuturesTimeout:
+                response = make_response("Chart is still rendering, please retry shortly.", 503)
+                response.headers['Retry-After'] = '5'
+                return response
+            except Exception as e:
+                logging.error(f"On-demand {key} render of chart {chart_id} failed: {e}")
+                return "Chart rendering failed. Please try again.", 500
+        response = make_response(image)
+        response.mimetype = CHART_FORMATS[fmt]
+    response.set_etag(f"{chart_id}.{key}")
+    response.cache_control.private = True
+    response.cache_control.max_age = CHART_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+# ---------------------------
+# MACC analytics (JSON)
+# ---------------------------
+@app.route("/analytics", methods=["POST"])
+def analytics():
+    if "user" not in session:
+        return jsonify(error="Not logged in."), 401
+    try:
+        upload = request.files.get("interventions_file")
+        if upload and upload.filename:
+            categories, values, widths = parse_interventions_file(upload.stream, upload.filename)
+            line_value = parse_line_value(request.form.get("line_value"))
+        else:
+            data = request.get_json(silent=True) if request.is_json else request.form
+            if not hasattr(data, "get"):
+                return jsonify(error="Request body must be a JSON object."), 400
+            categories, values, widths, line_value = parse_chart_form(data)
+    except FieldError as e:
+        return jsonify(error=str(e), detail=e.to_dict()), 400
+    except InputError as e:
+        return jsonify(error=str(e)), 400
+
+    if not len(categories) or len(categories) != len(values) or len(categories) != len(widths):
+        return jsonify(error="Categories, values and widths must be non-empty and of equal length."), 400
+    return jsonify(macc_analytics(categories, values, widths, line_value))
+
+# ---------------------------
+# Batch generation (many organisations per upload)
+# ---------------------------
+BATCH_MAX_ORGS = int(os.environ.get('BATCH_MAX_ORGS', 200))
+
+def batch_specs(orgs, sort=True):
+    specs = []
+    for org in orgs:
+        categories, values, widths = org['categories'], org['values'], org['widths']
+        if sort:
+            categories, values, widths = sort_by_cost(categories, values, widths)
+        specs.append((org['organisation'], categories, values, widths, org['line_value']))
+    return specs
+
+def iter_batch_results(orgs, fmt, sort=True, profile=DEFAULT_PROFILE):
+    for i, result in render_queue.render_many(batch_specs(orgs, sort=sort), fmt=fmt, profile=profile):
+        yield orgs[i]['organisation'], result
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    if "user" not in session:
+        return redirect(url_for("login"))
+    user = current_account()
+    if user is None:
+        return redirect(url_for("login"))
+    if not user.approved:
+        return "<h2>Access Denied.</h2><p>Your account is not yet approved by the admin.</p>", 403
+
+    upload = request.files.get("file")
+    try:
+        with span('batch_parse'):
+            if upload and upload.filename:
+                orgs = parse_batch(upload.stream, upload.filename, upload.mimetype)
+            elif request.is_json:
+                orgs = parse_batch(request.stream, content_type=request.mimetype)
+            else:
+                return "Error: Upload a CSV or JSON file.", 400
+    except InputError as e:
+        logging.error(f"Batch upload rejected for {user.email}: {e}")
+        return f"Error: {e}", 400
+    if len(orgs) > BATCH_MAX_ORGS:
+        return f"Error: A batch can contain at most {BATCH_MAX_ORGS} organisations.", 400
+
+    fmt = request.args.get("format") or request.form.get("format", "png")
+    if fmt not in CHART_FORMATS:
+        return f"Error: Unsupported format {fmt}.", 400
+    profile = request.args.get("profile") or request.form.get("profile", DEFAULT_PROFILE)
+    if profile not in RENDER_PROFILES:
+        return f"Error: Unknown render profile {profile}.", 400
+    sort = (request.args.get("sort") or request.form.get("sort", "1")) != "0"
+
+    # The whole batch is charged up front in one transaction; every chart that
+    # doesn't make it into the archive (failed, or never rendered because the
+    # client went away) is refunded together when the stream ends.
+    try:
+        with span('quota'):
+            reserved = reserve_quota(user, count=len(orgs), reason='batch')
+        if not reserved:
+            return f"Error: This batch needs {len(orgs)} charts but only {user.quota} remain in your quota.", 403
+    except Exception:
+        return "Internal server error.", 500
+
+    user_id = user.id
+    failures = []
+
+    def generate():
+        written = []
+
+        def results():
+            for organisation, result in iter_batch_results(orgs, fmt, sort=sort, profile=profile):
+                if not isinstance(result, Exception):
+                    written.append(organisation)  # iter_chart_zip adds it before asking for the next
+                yield organisation, result
+
+        charts = results()
+        completed = False
+        try:
+            yield from iter_chart_zip(charts, fmt, failures)
+            completed = True
+        finally:
+            # On a disconnect this stops render_many, which cancels the renders not yet started
+            charts.close()
+            if completed:
+                logging.info(f"Batch of {len(orgs)} charts streamed ({len(failures)} failed)")
+            else:
+                logging.info(f"Batch stream closed after {len(written)} of {len(orgs)} charts")
+            unwritten = len(orgs) - len(written)
+            if unwritten:
+                reason = 'batch render failed' if completed else 'batch interrupted'
+                refund_quota(user_id, count=unwritten, reason=reason)
+
+    response = Response(stream_with_context(generate()), mimetype="application/zip")
+    response.headers["Content-Disposition"] = "attachment; filename=macc_charts.zip"
+    return response
+
+@app.cli.command("render-batch")
+@click.argument("input_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output_zip", type=click.Path(dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(sorted(CHART_FORMATS)), default="png", show_default=True)
+@click.option("--profile", type=click.Choice(sorted(RENDER_PROFILES)), default=DEFAULT_PROFILE, show_default=True,
+              help="Resolution of PNG output.")
+@click.option("--keep-order", is_flag=True, help="Plot interventions in file order instead of by cost.")
+def render_batch_command(input_file, output_zip, fmt, profile, keep_order):
+    """Render every organisation in INPUT_FILE (CSV or JSON) into OUTPUT_ZIP."""
+    try:
+        with open(input_file, "rb") as f:
+            orgs = parse_batch(f, input_file)
+    except InputError as e:
+        raise click.ClickException(str(e))
+    failures = []
+    with open(output_zip, "wb") as out:
+        for chunk in iter_chart_zip(iter_batch_results(orgs, fmt, sort=not keep_order, profile=profile), fmt, failures):
+            out.write(chunk)
+    click.echo(f"Wrote {len(orgs) - len(failures)} of {len(orgs)} charts to {output_zip}")
 
 # ---------------------------
 # Admin panel
@@ -826,6 +936,7 @@ def admin():
             target_user = User.query.filter_by(email=target_user_email).first()
             if target_user:
                 target_user.approved = True
+                forget_remember_token(target_user.remember_token)
                 try:
                     db.session.commit()
                     message = f"{target_user_email} approved."
@@ -842,6 +953,9 @@ def admin():
             if target_user:
                 new_password = secrets.token_urlsafe(12)
                 target_user.set_password(new_password)
+                # A reset also signs out remembered devices
+                forget_remember_token(target_user.remember_token)
+                target_user.remember_token = None
                 try:
                     db.session.commit()
                     message = f"Password reset for {target_user_email}. New temporary password: {new_password}"
@@ -876,14 +990,312 @@ def admin():
                 message = "Invalid quota input."
                 logging.error(f"Invalid quota input for {target_user_email}")
 
-    users = User.query.all()
+    return render_admin_page(message)
+
+def render_admin_page(message="", bulk_report=None):
+    try:
+        users, next_cursor = admin_user_page(request.args)
+    except ValueError:
+        users, next_cursor = admin_user_page({})
+        message = message or "Invalid page cursor."
+    usage = recent_usage(limit=ADMIN_USAGE_ROWS)
     logging.debug("Rendering admin panel")
-    return render_template_string(ADMIN_TEMPLATE, users=users, message=message)
+    return render_template("admin.html", users=users, usage=usage, message=message, next_cursor=next_cursor,
+                           q=request.args.get("q", ""), status=request.args.get("status", ""),
+                           bulk_report=bulk_report)
+
+# ---------------------------
+# Bulk admin actions
+# ---------------------------
+BULK_MAX_EMAILS = int(os.environ.get('BULK_MAX_EMAILS', 1000))
+BULK_ACTIONS = ('approve', 'quota', 'reset_password')
+
+def parse_email_list(raw=None, upload=None):
+    """Emails from a comma/whitespace separated string (or a list) plus an optional
+    CSV upload, which uses its 'email' column or else the first column. Blank and
+    repeated entries are dropped; the submitted order is kept."""
+    emails = []
+    if isinstance(raw, str):
+        emails.extend(re.split(r'[\s,;]+', raw))
+    elif raw:
+        emails.extend(str(e) for e in raw)
+    if upload is not None and upload.filename:
+        reader = csv.reader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+        column = 0
+        for line_no, row in enumerate(reader):
+            if line_no == 0:
+                names = [c.strip().lower() for c in row]
+                if 'email' in names:
+                    column = names.index('email')
+                    continue
+            if column < len(row):
+                emails.append(row[column])
+    return list(dict.fromkeys(e.strip() for e in emails if e.strip()))
+
+def bulk_admin_update(action, emails, quota=None):
+    """Apply ``action`` to every listed user in one transaction.
+
+    Approvals and quota changes are a single UPDATE ... WHERE email IN (...); password
+    resets need a distinct hash per user, so they go out as one executemany UPDATE
+    keyed by id. Returns one result dict per email, in the order given.
+    """
+    report = {}
+    valid = []
+    for email in emails:
+        if re.match(EMAIL_REGEX, email):
+            valid.append(email)
+        else:
+            report[email] = {'status': 'invalid'}
+
+    found = {}
+    if valid:
+        rows = db.session.query(User.id, User.email, User.remember_token).filter(User.email.in_(valid)).all()
+        found = {row.email: row for row in rows}
+    for email in valid:
+        if email not in found:
+            report[email] = {'status': 'not_found'}
+
+    if found:
+        passwords = {}
+        try:
+            if action == 'approve':
+                db.session.execute(update(User).where(User.email.in_(found)).values(approved=True))
+            elif action == 'quota':
+                db.session.execute(update(User).where(User.email.in_(found)).values(quota=quota))
+            else:
+                passwords = {email: secrets.token_urlsafe(12) for email in found}
+                hashes = password_pool.map(bcrypt.generate_password_hash, passwords.values())
+                db.session.execute(update(User), [
+                    {'id': found[email].id, 'password': hashed.decode('utf-8'), 'remember_token': None}
+                    for email, hashed in zip(passwords, hashes)
+                ])
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Bulk {action} failed for {len(found)} users: {e}")
+            db.session.rollback()
+            for email in found:
+                report[email] = {'status': 'error'}
+        else:
+            done = {'approve': 'approved', 'quota': 'updated', 'reset_password': 'reset'}[action]
+            for email, row in found.items():
+                if action != 'quota':
+                    forget_remember_token(row.remember_token)
+                report[email] = {'status': done}
+                if email in passwords:
+                    report[email]['password'] = passwords[email]
+            logging.info(f"Bulk {action} applied to {len(found)} users")
+    return [{'email': email, **report[email]} for email in emails]
+
+@app.route("/admin/bulk", methods=["POST"])
+def admin_bulk():
+    wants_json = request.is_json
+    if session.get("user") != "admin@example.com":
+        if wants_json:
+            return jsonify(error="Admin only."), 403
+        return redirect(url_for("login"))
+
+    def fail(message):
+        if wants_json:
+            return jsonify(error=message), 400
+        return render_admin_page(message), 400
+
+    data = request.get_json(silent=True) if wants_json else request.form
+    if not hasattr(data, "get"):
+        return fail("Expected a JSON object.")
+    action = data.get("action")
+    if action not in BULK_ACTIONS:
+        return fail(f"Unknown bulk action; expected one of: {', '.join(BULK_ACTIONS)}.")
+
+    quota = None
+    if action == "quota":
+        # An empty quota means unlimited, as in the single-user form
+        raw_quota = data.get("quota")
+        try:
+            quota = int(raw_quota) if raw_quota not in (None, "") else None
+        except (TypeError, ValueError):
+            return fail("Invalid quota input.")
+
+    raw_emails = data.get("emails")
+    if raw_emails is not None and not isinstance(raw_emails, (str, list)):
+        return fail("Emails must be a list or comma-separated string.")
+    try:
+        emails = parse_email_list(raw_emails, request.files.get("emails_file"))
+    except (UnicodeDecodeError, csv.Error) as e:
+        logging.error(f"Unreadable bulk email upload: {e}")
+        return fail("Could not read the uploaded email list.")
+    if not emails:
+        return fail("No emails given.")
+    if len(emails) > BULK_MAX_EMAILS:
+        return fail(f"Too many emails; the limit is {BULK_MAX_EMAILS} per request.")
+
+    report = bulk_admin_update(action, emails, quota)
+    applied = sum(1 for r in report if r['status'] in ('approved', 'updated', 'reset'))
+    if wants_json:
+        return jsonify(action=action, applied=applied, results=report)
+    return render_admin_page(f"Bulk {action.replace('_', ' ')}: {applied} of {len(report)} users updated.",
+                             bulk_report=report)
+
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 200
+
+def encode_user_cursor(user):
+    raw = f"{user.created_at.isoformat() if user.created_at else ''}|{user.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_user_cursor(cursor):
+    try:
+        created_at, user_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return (datetime.fromisoformat(created_at) if created_at else None), int(user_id)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def admin_user_page(args):
+    """One page of users, newest first, using keyset pagination on (created_at, id).
+
+    ``args`` may contain q (email prefix), status ('pending' or 'exhausted'),
+    limit and cursor (from the previous page). Returns (users, next_cursor).
+    """
+    query = User.query
+    prefix = (args.get("q") or "").strip()
+    if prefix:
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(User.email.like(f"{escaped}%", escape="\\"))
+    status = args.get("status")
+    if status == "pending":
+        query = query.filter(User.approved.is_(False))
+    elif status == "exhausted":
+        query = query.filter(User.quota.isnot(None), User.quota <= 0)
+
+    cursor = args.get("cursor")
+    if cursor:
+        created_at, user_id = decode_user_cursor(cursor)
+        if created_at is None:
+            query = query.filter(User.created_at.is_(None), User.id < user_id)
+        else:
+            query = query.filter(or_(
+                User.created_at < created_at,
+                and_(User.created_at == created_at, User.id < user_id),
+                User.created_at.is_(None),
+            ))
+
+    try:
+        limit = max(1, min(int(args.get("limit", ADMIN_PAGE_SIZE)), ADMIN_MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = ADMIN_PAGE_SIZE
+    users = query.order_by(User.created_at.desc().nulls_last(), User.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_user_cursor(users[limit - 1]) if len(users) > limit else None
+    return users[:limit], next_cursor
+
+@app.route("/admin/users.json", methods=["GET"])
+def admin_users_json():
+    if session.get("user") != "admin@example.com":
+        return jsonify(error="Admin only."), 403
+    try:
+        users, next_cursor = admin_user_page(request.args)
+    except ValueError:
+        return jsonify(error="Invalid cursor."), 400
+    return jsonify(
+        users=[
+            {
+                'id': u.id,
+                'email': u.email,
+                'quota': u.quota,
+                'approved': bool(u.approved),
+                'created_at': u.created_at.isoformat() if u.created_at else None,
+                'last_login': u.last_login.isoformat() if u.last_login else None,
+            }
+            for u in users
+        ],
+        next_cursor=next_cursor,
+    )
+
+ADMIN_USAGE_ROWS = 50
+
+def recent_usage(email=None, limit=ADMIN_USAGE_ROWS):
+    # Reads only the ledger (joined for the email), never locking User rows
+    query = db.session.query(UsageLedger, User.email).join(User, User.id == UsageLedger.user_id)
+    if email:
+        query = query.filter(User.email == email)
+    return query.order_by(UsageLedger.id.desc()).limit(limit).all()
+
+@app.route("/admin/usage", methods=["GET"])
+def admin_usage():
+    if session.get("user") != "admin@example.com":
+        return redirect(url_for("login"))
+    limit = max(1, min(request.args.get("limit", ADMIN_USAGE_ROWS, type=int), 1000))
+    rows = recent_usage(email=request.args.get("email", "").strip() or None, limit=limit)
+    return jsonify(usage=[
+        {
+            'email': email,
+            'amount': entry.amount,
+            'reason': entry.reason,
+            'reference': entry.reference,
+            'created_at': entry.created_at.isoformat() if entry.created_at else None,
+        }
+        for entry, email in rows
+    ])
+
+@app.route("/admin/cache", methods=["GET"])
+def admin_cache_stats():
+    if session.get("user") != "admin@example.com":
+        return redirect(url_for("login"))
+    return jsonify(chart=chart_cache.stats())
+
+# Prometheus scrape endpoint. Scrapers send "Authorization: Bearer <METRICS_TOKEN>"
+# and admins can read it from their session; nobody else can unless METRICS_PUBLIC=1
+# (only for deployments where /metrics isn't reachable from outside).
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def metrics_allowed():
+    if METRICS_PUBLIC or session.get("user") == "admin@example.com":
+        return True
+    if not METRICS_TOKEN:
+        return False
+    return secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    if not metrics_allowed():
+        return "Forbidden", 403
+    lines = stage_seconds.exposition() + request_seconds.exposition()
+    cache = chart_cache.stats()
+    lines += metric_lines('macc_chart_cache_entries', 'Charts held in the in-process cache.', cache['entries'])
+    lines += metric_lines('macc_chart_cache_bytes', 'Bytes of chart files held in the in-process cache.', cache['bytes'])
+    lines += metric_lines('macc_chart_cache_hits_total', 'Chart cache hits.', cache['hits'], kind='counter')
+    lines += metric_lines('macc_chart_cache_misses_total', 'Chart cache misses.', cache['misses'], kind='counter')
+    pool = pool_stats(db.engine)
+    if 'checked_out' in pool:
+        lines += metric_lines('macc_db_pool_checked_out', 'Database connections in use.', pool['checked_out'])
+        lines += metric_lines('macc_db_pool_overflow', 'Connections open beyond the pool size.', pool['overflow'])
+    lines += metric_lines('macc_db_pool_checkouts_total', 'Connection checkouts.', pool['checkouts'], kind='counter')
+    lines += metric_lines('macc_db_pool_wait_seconds_total', 'Time spent waiting for a connection.',
+                         pool['wait_total_seconds'], kind='counter')
+    lines += metric_lines('macc_db_pool_timeouts_total', 'Checkouts that timed out.', pool['timeouts'], kind='counter')
+    return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/admin/metrics", methods=["GET"])
+def admin_metrics():
+    if session.get("user") != "admin@example.com":
+        return redirect(url_for("login"))
+    return jsonify(db_pool=pool_stats(db.engine), chart_cache=chart_cache.stats(), stages=stage_seconds.snapshot())
+
+# ---------------------------
+# Worker start-up
+# ---------------------------
+def warm_up():
+    # Called once per serving process (gunicorn's post_worker_init, or the dev server
+    # below) rather than at import, so `flask` CLI commands don't pay for it.
+    precompile_templates()
+    render_queue.start()
 
 # ---------------------------
 # Run app
 # ---------------------------
 if __name__ == "__main__":
+    with app.app_context():
+        bootstrap_database()
+    warm_up()
     port = int(os.environ.get("PORT", 5000))
     # debug=True for local testing to enable autoreload
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,62 @@
+import re
+import zipfile
+
+# ---------------------------
+# Streaming ZIP of batch-rendered charts
+# ---------------------------
+
+class _ChunkBuffer:
+    """Write-only sink for ZipFile; it has no tell/seek, so ZipFile switches to
+    streaming mode (data descriptors) and we can hand out bytes as they are written."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def archive_name(organisation, fmt, taken):
+    base = re.sub(r'[^A-Za-z0-9._-]+', '_', organisation).strip('._') or 'chart'
+    name = f"{base}.{fmt}"
+    n = 2
+    while name in taken:
+        name = f"{base}_{n}.{fmt}"
+        n += 1
+    taken.add(name)
+    return name
+
+
+def iter_chart_zip(results, fmt, failures=None):
+    """Yield ZIP bytes for ``results``, an iterable of (organisation, image bytes or
+    Exception) pairs, writing each entry as soon as its render completes.
+
+    Failed renders are recorded in ``failures`` (if given) and listed in errors.txt.
+    """
+    sink = _ChunkBuffer()
+    taken = set()
+    errors = []
+    # Rendered images are already compressed, so store them as-is
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for organisation, result in results:
+            if isinstance(result, Exception):
+                errors.append(f"{organisation}: {result}")
+                if failures is not None:
+                    failures.append(organisation)
+            else:
+                archive.writestr(archive_name(organisation, fmt, taken), result)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        if errors:
+            archive.writestr('errors.txt', "\n".join(errors) + "\n")
+    yield sink.drain()
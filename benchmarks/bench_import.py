@@ -0,0 +1,77 @@
+"""Import-time benchmark for the web app (what every gunicorn worker and every
+`flask ...` command pays before doing anything useful).
+
+Run from the repository root:
+
+    python benchmarks/bench_import.py [--runs 5] [--top 15]
+
+Each run imports ``app`` in a fresh interpreter under ``python -X importtime``
+against a throwaway SQLite database and reports the median wall-clock time, the
+cumulative import time of ``app`` and the slowest top-level imports. It also
+says whether matplotlib was imported, which should only happen on first render.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_once(env):
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                          cwd=ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        sys.exit(proc.stderr)
+    cumulative = {}
+    matplotlib = False
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        name = match.group(4)
+        matplotlib = matplotlib or name.startswith('matplotlib')
+        # Keep `app` itself (indent 1) and the modules it imports directly (indent 3)
+        if len(match.group(3)) in (1, 3):
+            cumulative[name] = int(match.group(2)) / 1e6
+    return wall, cumulative, matplotlib
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    import_once(env)  # first run pays for creating the database file, if anything does
+
+    walls = []
+    per_module = defaultdict(list)
+    for _ in range(args.runs):
+        wall, cumulative, matplotlib = import_once(env)
+        walls.append(wall)
+        for name, seconds in cumulative.items():
+            per_module[name].append(seconds)
+
+    print(f"wall clock (median of {args.runs}): {statistics.median(walls) * 1000:8.1f} ms")
+    print(f"import app (cumulative):       {statistics.median(per_module['app']) * 1000:8.1f} ms")
+    print(f"matplotlib imported:           {'yes' if matplotlib else 'no'}")
+    print()
+    print(f"{'imported by app':<40} {'ms':>8}")
+    per_module.pop('app')
+    slowest = sorted(per_module.items(), key=lambda kv: statistics.median(kv[1]), reverse=True)
+    for name, samples in slowest[:args.top]:
+        print(f"{name:<40} {statistics.median(samples) * 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
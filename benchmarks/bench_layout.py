@@ -0,0 +1,91 @@
+"""Layout benchmark: margins from font metrics vs. bbox_inches='tight'.
+
+Run from the repository root:
+
+    python benchmarks/bench_layout.py
+
+``bbox_inches='tight'`` makes savefig draw the whole figure once just to measure
+it and then again to write the file. The renderer now sizes its margins from
+cached font metrics instead, so each chart is drawn once. For N = 10, 100 and 1000
+bars this prints the Figure.draw calls and save time of both paths, and checks
+that nothing the renderer draws falls outside the figure, including a chart
+whose title is wider than its plot area.
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_render import make_dataset  # noqa: E402
+from macc_renderer import build_figure  # noqa: E402
+from matplotlib.figure import Figure  # noqa: E402
+
+SIZES = (10, 100, 1000)
+LONG_TITLE = ("Acme Manufacturing Decarbonisation Plan 2030", 3)  # project name, bars
+REPEATS = 3
+DPI = 100
+
+draw_calls = 0
+_figure_draw = Figure.draw
+
+
+def counting_draw(self, renderer):
+    global draw_calls
+    draw_calls += 1
+    return _figure_draw(self, renderer)
+
+
+Figure.draw = counting_draw
+
+
+def time_save(n, tight):
+    global draw_calls
+    categories, values, widths = make_dataset(n)
+    best = None
+    for _ in range(REPEATS):
+        fig = build_figure("Benchmark", categories, values, widths, line_value=25)
+        draw_calls = 0
+        start = time.perf_counter()
+        if tight:
+            fig.savefig(io.BytesIO(), format="png", bbox_inches='tight', dpi=DPI)
+        else:
+            fig.savefig(io.BytesIO(), format="png", dpi=DPI)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, draw_calls, fig)
+    return best
+
+
+def overflow(fig):
+    # How far (in points) the drawn content sticks out past each edge of the figure
+    inner = fig.get_tightbbox(fig.canvas.get_renderer())
+    width, height = fig.get_size_inches()
+    return {
+        'left': -inner.x0 * 72,
+        'bottom': -inner.y0 * 72,
+        'right': (inner.x1 - width) * 72,
+        'top': (inner.y1 - height) * 72,
+    }
+
+
+def main():
+    print(f"{'N':>6} {'mode':>8} {'draws':>6} {'save s':>9} {'size in':>14} {'max overflow pt':>16}")
+    for n in SIZES:
+        for tight in (True, False):
+            elapsed, draws, fig = time_save(n, tight)
+            width, height = fig.get_size_inches()
+            worst = max(overflow(fig).values()) if not tight else float('nan')
+            mode = "tight" if tight else "metrics"
+            print(f"{n:>6} {mode:>8} {draws:>6} {elapsed:>9.3f} {width:>6.1f}x{height:<6.1f} {worst:>16.1f}")
+
+    project_name, n = LONG_TITLE
+    fig = build_figure(project_name, *make_dataset(n), line_value=25)
+    fig.savefig(io.BytesIO(), format="png", dpi=DPI)
+    edges = ", ".join(f"{edge} {pt:.1f}" for edge, pt in overflow(fig).items())
+    print(f"\nLong title, {n} bars: overflow pt {edges}")
+
+
+if __name__ == "__main__":
+    main()
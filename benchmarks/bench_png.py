@@ -0,0 +1,67 @@
+"""PNG encoder benchmark: encode time and file size for each entry of PNG_ENCODERS.
+
+Run from the repository root:
+
+    python benchmarks/bench_png.py
+
+For N = 10, 100 and 1000 bars, the chart is drawn at each render profile's
+resolution and written with every encoder. The encode time includes the draw,
+because matplotlib's writers draw and compress in a single savefig call; the
+time of a bare canvas draw at the same DPI is printed alongside for reference.
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_render import make_dataset  # noqa: E402
+from macc_renderer import PNG_ENCODERS, RENDER_PROFILES, build_figure, profile_dpi  # noqa: E402
+
+SIZES = (10, 100, 1000)
+REPEATS = 3
+
+
+def time_encode(fig, dpi, encoder):
+    best = None
+    for _ in range(REPEATS):
+        out = io.BytesIO()
+        start = time.perf_counter()
+        PNG_ENCODERS[encoder](fig, dpi, out)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, len(out.getvalue()))
+    return best
+
+
+def time_draw(fig, dpi):
+    fig.dpi = dpi
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fig.canvas.draw()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    print(f"{'N':>6} {'profile':>10} {'pixels':>11} {'draw s':>7} {'encoder':>8} {'encode s':>9} {'size KiB':>9} {'vs default':>10}")
+    for n in SIZES:
+        categories, values, widths = make_dataset(n)
+        fig = build_figure("Benchmark", categories, values, widths, line_value=25)
+        for profile in RENDER_PROFILES:
+            dpi = profile_dpi(profile, fig.get_size_inches())
+            width, height = (int(side * dpi) for side in fig.get_size_inches())
+            draw = time_draw(fig, dpi)
+            baseline = None
+            for encoder in PNG_ENCODERS:
+                elapsed, size = time_encode(fig, dpi, encoder)
+                baseline = baseline or size
+                print(f"{n:>6} {profile:>10} {width:>5}x{height:<5} {draw:>7.3f} {encoder:>8} {elapsed:>9.3f} "
+                      f"{size / 1024:>9.1f} {size / baseline:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
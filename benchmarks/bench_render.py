@@ -0,0 +1,70 @@
+"""Render-time benchmark for the MACC renderer at N = 10, 100 and 1000 bars.
+
+Run from the repository root:
+
+    python benchmarks/bench_render.py
+
+For comparison, each size is also drawn with the old per-bar style: one vlines()
+call per bar instead of a single LineCollection.
+"""
+import io
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from macc_renderer import build_figure, label_layout  # noqa: E402
+
+SIZES = (10, 100, 1000)
+REPEATS = 3
+
+
+def make_dataset(n, seed=0):
+    rng = random.Random(seed)
+    categories = [f"Intervention {i}" for i in range(n)]
+    values = [round(rng.uniform(-100, 150), 1) for _ in range(n)]
+    widths = [round(rng.uniform(0.5, 10), 1) for _ in range(n)]
+    return categories, values, widths
+
+
+def per_bar_guides(ax, values, widths):
+    # Old approach: one vlines() call (and so one LineCollection) per bar
+    layout = label_layout(values, widths)
+    for x, start, end in zip(layout['centres'], layout['segments'][:, 0, 1], layout['segments'][:, 1, 1]):
+        ax.vlines(x, start, end, colors='black', linestyles='dashed', linewidth=1)
+
+
+def time_render(n, legacy=False):
+    categories, values, widths = make_dataset(n)
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fig = build_figure("Benchmark", categories, values, widths, line_value=25)
+        if legacy:
+            ax = fig.axes[0]
+            for collection in list(ax.collections):  # the only collection is the guide lines
+                collection.remove()
+            per_bar_guides(ax, values, widths)
+        built = time.perf_counter()
+        fig.savefig(io.BytesIO(), format="png", dpi=150)
+        done = time.perf_counter()
+        artists = len(fig.axes[0].get_children())
+        sample = (built - start, done - built, done - start, artists)
+        if best is None or sample[2] < best[2]:
+            best = sample
+    return best
+
+
+def main():
+    print(f"{'N':>6} {'mode':>12} {'build s':>9} {'save s':>9} {'total s':>9} {'artists':>8}")
+    for n in SIZES:
+        for legacy in (True, False):
+            build, save, total, artists = time_render(n, legacy=legacy)
+            mode = "per-bar" if legacy else "collection"
+            print(f"{n:>6} {mode:>12} {build:>9.3f} {save:>9.3f} {total:>9.3f} {artists:>8}")
+
+
+if __name__ == "__main__":
+    main()
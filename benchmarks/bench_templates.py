@@ -0,0 +1,56 @@
+"""Page render microbenchmark: render_template_string vs precompiled templates.
+
+Run from the repository root:
+
+    python benchmarks/bench_templates.py
+
+The 'before' column passes each template's source to render_template_string, as
+the app used to on every request. The 'after' column uses render_template, which
+renders the compiled template cached at startup.
+"""
+import os
+import sys
+import time
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+import logging  # noqa: E402
+logging.disable(logging.CRITICAL)
+
+from flask import render_template, render_template_string  # noqa: E402
+from app import app  # noqa: E402
+
+ITERATIONS = 2000
+PAGES = {
+    'auth.html': dict(title="Login", message=""),
+    'index.html': dict(chart=None, job_id=None, last_login=None),
+    'admin.html': dict(users=[], message=""),
+    'quota_exhausted.html': {},
+}
+
+
+def per_render_us(fn):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fn()
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+
+def main():
+    print(f"{'template':<22} {'before us':>10} {'after us':>10} {'speed-up':>9}")
+    with app.test_request_context('/'):
+        from flask import session
+        session['user'] = 'bench@example.com'
+        for name, context in PAGES.items():
+            with open(os.path.join(ROOT, 'templates', name)) as f:
+                source = f.read()
+            before = per_render_us(lambda: render_template_string(source, **context))
+            after = per_render_us(lambda: render_template(name, **context))
+            print(f"{name:<22} {before:>10.1f} {after:>10.1f} {before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
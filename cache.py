@@ -0,0 +1,116 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+# ---------------------------
+# Bounded in-process LRU cache
+# ---------------------------
+class LRUCache:
+    """Thread-safe, size-bounded LRU mapping with hit/miss counters.
+
+    Bounded by entry count and, if ``max_bytes`` is given, by the total of
+    ``sizeof(value)`` over all entries. Sizes are taken when a value is put, so a
+    value that grows in place must be put again to be re-counted.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, sizeof=None):
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._discard(key)
+            self._data[key] = value
+            if self.max_bytes is not None:
+                self._sizes[key] = self._sizeof(value)
+                self.total_bytes += self._sizes[key]
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                self._discard(next(iter(self._data)))
+                self.evictions += 1
+
+    def _discard(self, key, default=None):
+        # Caller holds the lock
+        self.total_bytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._discard(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+# ---------------------------
+# LRU cache with per-entry expiry
+# ---------------------------
+class TTLCache(LRUCache):
+    """LRUCache whose entries also expire ``ttl`` seconds after being stored."""
+
+    def __init__(self, max_entries=1024, ttl=300, clock=time.monotonic):
+        super().__init__(max_entries=max_entries)
+        self.ttl = ttl
+        self._clock = clock
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > self._clock():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                self._discard(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        super().put(key, (self._clock() + self.ttl, value))
+
+    def pop(self, key, default=None):
+        item = super().pop(key, None)
+        return default if item is None else item[1]
@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# ---------------------------
+# Database engine options and pool health
+# ---------------------------
+# Everything is driven by environment variables so each deployment can size its
+# pool to match its gunicorn worker/thread count and database connection limit:
+#
+#     DB_POOL_SIZE             persistent connections per process (default 5)
+#     DB_MAX_OVERFLOW          extra connections allowed under load (default 10)
+#     DB_POOL_TIMEOUT          seconds to wait for a free connection (default 30)
+#     DB_POOL_RECYCLE          replace connections older than this many seconds (default 1800)
+#     DB_POOL_PRE_PING         test connections on checkout, dropping dead ones (default on)
+#     DB_STATEMENT_TIMEOUT_MS  Postgres statement_timeout, 0 to disable (default 30000)
+#     SQLITE_BUSY_TIMEOUT_MS   how long SQLite waits on a locked database (default 5000)
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class PoolMetrics:
+    """Counts connection checkouts and how long callers waited for them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total_seconds': self.wait_total,
+                'wait_max_seconds': self.wait_max,
+                'wait_avg_seconds': (self.wait_total / self.checkouts) if self.checkouts else 0.0,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited (including connecting)."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            pool_metrics.record(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_metrics.record(time.perf_counter() - started)
+        return conn
+
+
+def engine_options(database_url):
+    """SQLALCHEMY_ENGINE_OPTIONS for ``database_url``."""
+    if database_url.startswith('sqlite'):
+        if ':memory:' in database_url or database_url.rstrip('/') == 'sqlite:':
+            return {}
+        # WAL and busy_timeout are set per connection by configure_sqlite()
+        return {'poolclass': TimedQueuePool}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': _env_flag('DB_POOL_PRE_PING', '1'),
+    }
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))
+    if statement_timeout and database_url.startswith('postgres'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+
+def configure_sqlite(engine):
+    """Use WAL (readers don't block the writer) and a busy timeout on every connection."""
+    busy_ms = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={busy_ms}')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(0, pool.overflow()),
+            'timeout_seconds': pool.timeout(),
+        })
+    stats.update(pool_metrics.snapshot())
+    return stats
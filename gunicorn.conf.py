@@ -0,0 +1,8 @@
+# gunicorn picks this file up automatically from the working directory.
+
+def post_worker_init(worker):
+    # Compile templates and spawn/warm this worker's render pool before it accepts
+    # requests, so the first chart after a deploy/restart doesn't pay matplotlib's
+    # cold start. Database tables are created by `flask bootstrap` at deploy time.
+    from app import warm_up
+    warm_up()
@@ -0,0 +1,352 @@
+import io
+import os
+import csv
+import json
+import math
+from array import array
+
+import numpy as np
+
+# ---------------------------
+# Parsing of uploaded MACC datasets
+# ---------------------------
+# Batch uploads describe many organisations at once, either as CSV with one row
+# per intervention:
+#
+#     organisation,intervention,cost,abatement,carbon_price
+#     Plant A,LED retrofit,-20,1.5,50
+#
+# or as JSON: a list of {"organisation", "carbon_price", "interventions": [{"name",
+# "cost", "abatement"}, ...]} objects (or with parallel "categories"/"values"/"widths").
+#
+# Numeric columns are appended to typed array('d') buffers while the file is read and
+# handed out as float64 NumPy arrays, so large uploads never become lists of floats.
+
+UPLOAD_MAX_ROWS = int(os.environ.get('UPLOAD_MAX_ROWS', 100000))
+
+class InputError(ValueError):
+    """Raised for malformed uploads; the message is safe to show to the user."""
+
+
+class FieldError(InputError):
+    """A single token in a form field that could not be used, with its position."""
+
+    def __init__(self, field, index, token, reason):
+        self.field = field
+        self.index = index
+        self.token = token
+        self.reason = reason
+        where = field if index is None else f"{field} item {index + 1}"
+        super().__init__(f"{where} ({token!r}) {reason}")
+
+    def to_dict(self):
+        return {'field': self.field, 'index': self.index, 'token': self.token, 'reason': self.reason}
+
+
+def parse_number_field(raw, field):
+    """Parse a comma-separated field (or a JSON list) into a contiguous float64 array.
+
+    Clean input is converted by NumPy in one call; only when that fails do we walk
+    the tokens to report which one was bad.
+    """
+    if isinstance(raw, str):
+        tokens = raw.split(',')
+    elif isinstance(raw, (list, tuple)):
+        tokens = [str(t) for t in raw]
+    else:
+        raise FieldError(field, None, raw, "must be a list or comma-separated string")
+    positions = range(len(tokens))
+    try:
+        numbers = np.array(tokens, dtype=np.float64)
+    except ValueError:
+        # Drop empty tokens (e.g. a trailing comma) but remember where each kept
+        # one was, so errors point at the item the user actually typed
+        kept = [(i, t.strip()) for i, t in enumerate(tokens) if t.strip() != '']
+        positions = [i for i, _ in kept]
+        try:
+            numbers = np.array([t for _, t in kept], dtype=np.float64)
+        except ValueError:
+            for i, token in kept:
+                try:
+                    float(token)
+                except ValueError:
+                    raise FieldError(field, i, token, "is not a number")
+            raise
+    bad = np.flatnonzero(~np.isfinite(numbers))
+    if bad.size:
+        i = positions[int(bad[0])]
+        raise FieldError(field, i, tokens[i].strip(), "must be a finite number")
+    return numbers
+
+
+def parse_chart_form(form):
+    """Parse the chart form (or an equivalent JSON object, where fields may be lists)
+    into (categories, values, widths, line_value)."""
+    categories = form.get('categories', '')
+    if isinstance(categories, str):
+        categories = categories.split(',')
+    elif not isinstance(categories, (list, tuple)):
+        raise FieldError('categories', None, categories, "must be a list or comma-separated string")
+    categories = [str(c).strip() for c in categories if str(c).strip() != '']
+    values = parse_number_field(form.get('values', ''), 'values')
+    widths = parse_number_field(form.get('widths', ''), 'widths')
+    return categories, values, widths, parse_line_value(form.get('line_value'))
+
+
+def parse_line_value(raw):
+    if raw in (None, '', 'None'):
+        return None
+    try:
+        value = float(raw)
+    except (TypeError, ValueError):
+        raise FieldError('line_value', None, raw, "is not a number")
+    if not math.isfinite(value):
+        raise FieldError('line_value', None, raw, "must be a finite number")
+    return value
+
+
+def dataset_stats(values, widths):
+    """Everything derived from the numeric columns, computed in one vectorised pass."""
+    values = np.asarray(values, dtype=np.float64)
+    widths = np.asarray(widths, dtype=np.float64)
+    n = values.size
+    x_positions = np.zeros(n)
+    np.cumsum(widths[:-1], out=x_positions[1:])
+    return {
+        'count': n,
+        'y_max': float(values.max()) if n else 0.0,
+        'y_min': float(values.min()) if n else 0.0,
+        'y_abs_max': float(np.abs(values).max()) if n else 0.0,
+        'x_positions': x_positions,
+        'centres': x_positions + widths / 2,
+        'total_abatement': float(widths.sum()),
+        'right_edge': float(x_positions[-1] + widths[-1]) if n else 0.0,
+    }
+
+
+def _number(raw, what, where):
+    try:
+        value = float(str(raw).strip())
+    except (TypeError, ValueError):
+        raise InputError(f"{where}: {what} {raw!r} is not a number")
+    if not math.isfinite(value):
+        raise InputError(f"{where}: {what} must be a finite number")
+    return value
+
+
+def _new_org(name):
+    return {'organisation': name, 'categories': [], 'values': array('d'), 'widths': array('d'), 'line_value': None}
+
+
+def _finish_org(org):
+    org['values'] = np.frombuffer(org['values'], dtype=np.float64)
+    org['widths'] = np.frombuffer(org['widths'], dtype=np.float64)
+    return org
+
+
+def _text_stream(stream, error="Upload must be UTF-8 text"):
+    # Lines of ``stream``; decoding happens lazily as the csv module reads, so a
+    # bad byte surfaces here as an InputError rather than mid-parse
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        yield from stream
+    except UnicodeDecodeError:
+        raise InputError(error)
+
+
+def _header_index(header, required):
+    names = [str(h or '').strip().lower() for h in header]
+    missing = [c for c in required if c not in names]
+    if missing:
+        raise InputError(f"Upload is missing column(s): {', '.join(missing)}")
+    return {c: names.index(c) for c in required}
+
+
+def _cell(row, i):
+    return row[i] if i < len(row) and row[i] is not None else ''
+
+
+def read_interventions(rows):
+    """Stream (intervention, cost, abatement) rows into one dataset.
+
+    ``rows`` yields sequences; the first one is the header. Each row is validated
+    as it arrives and the numbers go straight into typed buffers.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        raise InputError("Upload is empty")
+    cols = _header_index(header, ('intervention', 'cost', 'abatement'))
+    categories, values, widths = [], array('d'), array('d')
+    for line_no, row in enumerate(rows, start=2):
+        if not any(str(c).strip() for c in row if c is not None):
+            continue
+        where = f"row {line_no}"
+        name = str(_cell(row, cols['intervention'])).strip()
+        if not name:
+            raise InputError(f"{where}: intervention name is required")
+        values.append(_number(_cell(row, cols['cost']), 'cost', where))
+        widths.append(_number(_cell(row, cols['abatement']), 'abatement', where))
+        categories.append(name)
+        if len(categories) > UPLOAD_MAX_ROWS:
+            raise InputError(f"Upload exceeds {UPLOAD_MAX_ROWS} interventions")
+    if not categories:
+        raise InputError("Upload contains no interventions")
+    return categories, np.frombuffer(values, dtype=np.float64), np.frombuffer(widths, dtype=np.float64)
+
+
+def _csv_rows(stream):
+    return csv.reader(_text_stream(stream, "File must be UTF-8 CSV"))
+
+
+def _xlsx_rows(stream):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise InputError("XLSX uploads are not available on this server; please upload CSV")
+    try:
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+    except Exception as e:
+        raise InputError(f"Could not read XLSX file: {e}")
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def parse_interventions_file(stream, filename=''):
+    """Parse a single organisation's CSV or XLSX upload into (categories, values, widths)."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        return read_interventions(_xlsx_rows(stream))
+    return read_interventions(_csv_rows(stream))
+
+
+def parse_batch_csv(stream):
+    """Group CSV rows by organisation in a single pass over ``stream`` (bytes or text)."""
+    reader = csv.DictReader(_text_stream(stream))
+    fields = {(f or '').strip().lower() for f in (reader.fieldnames or [])}
+    missing = {'organisation', 'intervention', 'cost', 'abatement'} - fields
+    if missing:
+        raise InputError(f"Upload is missing column(s): {', '.join(sorted(missing))}")
+
+    orgs = {}
+    for line_no, row in enumerate(reader, start=2):
+        where = f"line {line_no}"
+        # Cells beyond the header land in a list under None; empty ones are just
+        # trailing commas (common in spreadsheet exports)
+        extra = row.pop(None, None)
+        if extra and any((v or '').strip() for v in extra):
+            raise InputError(f"{where}: more values than there are columns in the header")
+        row = {(k or '').strip().lower(): (v or '').strip() for k, v in row.items()}
+        name = row['organisation']
+        if not name or not row['intervention']:
+            raise InputError(f"{where}: organisation and intervention are required")
+        org = orgs.get(name)
+        if org is None:
+            org = orgs[name] = _new_org(name)
+        org['categories'].append(row['intervention'])
+        org['values'].append(_number(row['cost'], 'cost', where))
+        org['widths'].append(_number(row['abatement'], 'abatement', where))
+        if row.get('carbon_price'):
+            org['line_value'] = _number(row['carbon_price'], 'carbon_price', where)
+    return [_finish_org(org) for org in orgs.values()]
+
+
+def parse_batch_json(stream):
+    try:
+        data = json.load(stream)
+    except UnicodeDecodeError:
+        raise InputError("Upload must be UTF-8 text")
+    except ValueError as e:
+        raise InputError(f"Invalid JSON: {e}")
+    if isinstance(data, dict):
+        data = data.get('organisations', [])
+    if not isinstance(data, list):
+        raise InputError("JSON must be a list of organisations")
+
+    orgs = []
+    for i, item in enumerate(data):
+        where = f"organisation #{i + 1}"
+        if not isinstance(item, dict) or not str(item.get('organisation', '')).strip():
+            raise InputError(f"{where}: an 'organisation' name is required")
+        org = _new_org(str(item['organisation']).strip())
+        if 'interventions' in item:
+            if not isinstance(item['interventions'], list):
+                raise InputError(f"{where}: 'interventions' must be a list")
+            for j, iv in enumerate(item['interventions']):
+                iv_where = f"{where}, intervention #{j + 1}"
+                if not isinstance(iv, dict):
+                    raise InputError(f"{iv_where}: must be an object with name, cost and abatement")
+                org['categories'].append(str(iv.get('name', '')).strip())
+                org['values'].append(_number(iv.get('cost'), 'cost', iv_where))
+                org['widths'].append(_number(iv.get('abatement'), 'abatement', iv_where))
+        else:
+            for key in ('categories', 'values', 'widths'):
+                if not isinstance(item.get(key, []), list):
+                    raise InputError(f"{where}: '{key}' must be a list")
+            org['categories'] = [str(c).strip() for c in item.get('categories', [])]
+            org['values'].extend(_number(v, 'value', where) for v in item.get('values', []))
+            org['widths'].extend(_number(w, 'width', where) for w in item.get('widths', []))
+        if item.get('carbon_price') not in (None, ''):
+            org['line_value'] = _number(item['carbon_price'], 'carbon_price', where)
+        orgs.append(_finish_org(org))
+    return orgs
+
+
+def validate_orgs(orgs):
+    if not orgs:
+        raise InputError("No organisations found in upload")
+    for org in orgs:
+        n = len(org['categories'])
+        if n == 0:
+            raise InputError(f"{org['organisation']}: no interventions")
+        if not all(org['categories']):
+            raise InputError(f"{org['organisation']}: intervention names cannot be empty")
+        if n != len(org['values']) or n != len(org['widths']):
+            raise InputError(f"{org['organisation']}: mismatched lengths of inputs")
+    return orgs
+
+
+def parse_batch(stream, filename='', content_type=''):
+    if filename.lower().endswith('.json') or 'json' in (content_type or ''):
+        return validate_orgs(parse_batch_json(stream))
+    return validate_orgs(parse_batch_csv(stream))
+
+
+def sort_by_cost(categories, values, widths):
+    """Order interventions by marginal cost, cheapest first, as a MACC should be.
+    The sort is stable, so equal-cost interventions keep their submitted order."""
+    if len(categories) != len(values) or len(categories) != len(widths):
+        raise InputError("Mismatched lengths of inputs")
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(values, kind='stable')
+    return [categories[i] for i in order.tolist()], values[order], np.asarray(widths, dtype=np.float64)[order]
+
+
+def macc_analytics(categories, values, widths, line_value=None):
+    """Cumulative abatement and cost figures for a cost-sorted MACC, in O(N log N)."""
+    categories, values, widths = sort_by_cost(categories, values, widths)
+    cumulative = np.cumsum(widths)
+    total = float(cumulative[-1]) if cumulative.size else 0.0
+    costs = values * widths  # USD/t CO2 x Mt CO2 = million USD
+
+    # Sorted costs let us find the cut-off with a binary search instead of a scan
+    negative = int(np.searchsorted(values, 0.0, side='left'))
+    result = {
+        'count': int(values.size),
+        'total_abatement': total,
+        'net_cost': float(costs.sum()),
+        'negative_cost_abatement': float(cumulative[negative - 1]) if negative else 0.0,
+        'carbon_price': line_value,
+        'interventions': [
+            {'name': name, 'cost': cost, 'abatement': width, 'cumulative_abatement': cum}
+            for name, cost, width, cum in zip(categories, values.tolist(), widths.tolist(), cumulative.tolist())
+        ],
+    }
+    if line_value is not None:
+        below = int(np.searchsorted(values, line_value, side='right'))
+        result['abatement_below_carbon_price'] = float(cumulative[below - 1]) if below else 0.0
+        result['cost_below_carbon_price'] = float(costs[:below].sum())
+        result['interventions_below_carbon_price'] = below
+    return result
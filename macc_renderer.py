@@ -0,0 +1,434 @@
+import io
+import os
+import json
+import math
+import time
+import random
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+from cache import LRUCache
+from macc_inputs import dataset_stats
+
+# ---------------------------
+# MACC chart renderer
+# ---------------------------
+# Charts are drawn on a standalone Figure with its own Agg canvas instead of going
+# through pyplot, so nothing touches pyplot's global figure registry and several
+# charts can be rendered concurrently from different threads of one process.
+#
+# matplotlib is only imported when a chart is actually drawn: importing it costs
+# more than the rest of the web app put together, and most processes that import
+# this module (web workers serving cached charts, CLI commands) never draw one.
+# Render pool workers preload MATPLOTLIB_MODULES in their forkserver instead.
+
+MATPLOTLIB_MODULES = ['matplotlib.figure', 'matplotlib.collections', 'matplotlib.backends.backend_agg']
+
+RENDER_VERSION = 3  # bump when the drawing code changes so stale cache entries are ignored
+
+# Render profiles. The figure's size in inches (and so its layout) depends only on
+# the data, so every profile draws the same chart; a profile only decides how many
+# pixels to spend on it: the highest DPI, up to max_dpi, that keeps the canvas
+# within max_pixels. Interactive pages use the cheap 'screen' profile and
+# high-DPI 'print' renders are only made when someone asks for them. Each profile
+# also names the PNG encoder it uses (see PNG_ENCODERS below).
+RENDER_PROFILES = {
+    'thumbnail': {'max_pixels': 300_000, 'max_dpi': 50, 'png_encoder': 'palette'},
+    'screen': {'max_pixels': 2_000_000, 'max_dpi': 100, 'png_encoder': 'fast'},
+    'print': {'max_pixels': 25_000_000, 'max_dpi': 300, 'png_encoder': 'palette'},
+}
+DEFAULT_PROFILE = 'screen'
+MIN_DPI = 20
+
+
+def canonical_inputs(categories, values, widths):
+    return [list(categories),
+            np.asarray(values, dtype=np.float64).tolist(),
+            np.asarray(widths, dtype=np.float64).tolist()]
+
+
+def colour_seed(categories, values, widths):
+    # Bar colours depend only on the dataset, so retitling a chart keeps its colours
+    payload = json.dumps(canonical_inputs(categories, values, widths), separators=(',', ':'))
+    return int.from_bytes(hashlib.sha256(payload.encode('utf-8')).digest()[:8], 'big')
+
+
+def bar_colours(categories, values, widths):
+    rng = random.Random(colour_seed(categories, values, widths))
+    return ["#" + ''.join(rng.choices('0123456789ABCDEF', k=6)) for _ in categories]
+
+
+def label_layout(values, widths):
+    # All per-bar label and guide-line geometry in one vectorised pass, so the
+    # drawing code below only has to hand precomputed arrays to matplotlib.
+    values = np.asarray(values, dtype=np.float64)
+    stats = dataset_stats(values, widths)
+    n = stats['count']
+    x_positions = stats['x_positions']
+    centres = stats['centres']
+
+    y_max = stats['y_max']
+    y_min = stats['y_min']
+    y_abs_max = stats['y_abs_max']
+    small_offset = y_abs_max * 0.05 if y_abs_max > 0 else 1
+    label_y = y_min - small_offset if y_min < 0 else -small_offset
+    line_end_y = label_y + small_offset * 0.4
+
+    positive = values >= 0
+
+    # Dashed guides from the bar (or the axis, for positive bars) down to the labels
+    segments = np.empty((n, 2, 2))
+    segments[:, :, 0] = centres[:, None]
+    segments[:, 0, 1] = np.where(positive, 0.0, values)
+    segments[:, 1, 1] = line_end_y
+
+    # Abatement labels alternate between two rows so neighbours don't collide
+    stagger = (np.arange(n) % 2) * small_offset * 0.5
+    abatement_y = line_end_y - (small_offset * 0.5) - (stagger * 0.5)
+
+    return {
+        'x_positions': x_positions,
+        'centres': centres,
+        'positive': positive,
+        'value_y': np.where(positive, 0.9, 0.0),  # 0.1 gap above x-axis for positive, on it for negative
+        'segments': segments,
+        'abatement_y': abatement_y,
+        'y_max': y_max,
+        'y_min': y_min,
+        'small_offset': small_offset,
+        'total_y': label_y - small_offset * 0.5,
+        'total_abatement': stats['total_abatement'],
+        'right_edge': stats['right_edge'],
+    }
+
+
+def axes_size(count):
+    # Plot area in inches: wider for more interventions, fixed height
+    return 0.825 * max(10, min(35, count * 2)), 6.45
+
+
+# Text that sits outside the plot area, and its font sizes in points
+TITLE_SIZE = 18
+AXIS_LABEL_SIZE = 14
+TICK_LABEL_SIZE = 12
+OUTER_PAD = 7.2  # points of white space around the whole chart (0.1in, as bbox_inches='tight' used)
+
+
+@lru_cache(maxsize=8192)
+def text_extent(text, size):
+    """(width, height) in points of one line of ``text`` in the default font at ``size``.
+
+    Measured from the font's glyph metrics without a renderer, and cached per
+    string and size, so category names seen before cost a dict lookup.
+    """
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.textpath import text_to_path
+
+    width, height, _ = text_to_path.get_text_width_height_descent(text, FontProperties(size=size), ismath=False)
+    # matplotlib lays every line out at least as tall as "lp" (ascender + descender)
+    line_height = text_to_path.get_text_width_height_descent('lp', FontProperties(size=size), ismath=False)[1]
+    return width, max(height, line_height)
+
+
+def chart_margins(ax, title, ytick_labels, categories, total_overflow, axes_width):
+    """Margins (left, bottom, right, top) in points that just fit everything drawn
+    outside the plot area, which is what bbox_inches='tight' used to measure by
+    drawing the whole figure an extra time. ``axes_width`` is the plot area's width
+    in points, which the title is centred over."""
+    import matplotlib as mpl
+
+    rc = mpl.rcParams
+    x_ticks = rc['xtick.major.size'] + rc['xtick.major.pad']
+    y_ticks = rc['ytick.major.size'] + rc['ytick.major.pad']
+    label_pad = rc['axes.labelpad']
+
+    # Category names are rotated 90 degrees, so their width is how far they hang down
+    category_depth = max((text_extent(c, TICK_LABEL_SIZE)[0] for c in categories), default=0.0)
+    ytick_width = max((text_extent(t, TICK_LABEL_SIZE)[0] for t in ytick_labels), default=0.0)
+    axis_label_height = text_extent(ax.get_xlabel(), AXIS_LABEL_SIZE)[1]
+
+    left = OUTER_PAD + text_extent(ax.get_ylabel(), AXIS_LABEL_SIZE)[1] + label_pad + ytick_width + y_ticks
+    bottom = OUTER_PAD + axis_label_height + label_pad + category_depth + x_ticks
+    title_width, title_height = text_extent(title, TITLE_SIZE)
+    top = OUTER_PAD + title_height + rc['axes.titlepad']
+    if ax.yaxis.get_major_formatter().get_offset():
+        top += text_extent('1e6', TICK_LABEL_SIZE)[1]
+    right = OUTER_PAD + max(0.0, total_overflow)
+    # A title wider than the plot area hangs out evenly on both sides
+    title_overhang = OUTER_PAD + (title_width - axes_width) / 2
+    return max(left, title_overhang), bottom, max(right, title_overhang), top
+
+
+def profile_dpi(profile, figsize):
+    """DPI for ``profile`` on a figure of ``figsize`` inches."""
+    limits = RENDER_PROFILES[profile]
+    width, height = figsize
+    budget_dpi = math.sqrt(limits['max_pixels'] / (width * height))
+    return max(MIN_DPI, min(limits['max_dpi'], int(budget_dpi)))
+
+
+class ChartFigure:
+    """A chart's figure split into the part drawn from the dataset (bars, value and
+    abatement labels, guide lines, ticks, the Total label) and the overlays drawn
+    from the form's other fields: the title and the carbon price line and label.
+
+    ``set_overlays()`` can be called again on a drawn chart to retitle it or move
+    the carbon price line without rebuilding the hundreds of dataset artists; it
+    also redoes the y range and the margins, which both depend on the line.
+    """
+
+    def __init__(self, categories, values, widths):
+        from matplotlib.figure import Figure
+        from matplotlib.collections import LineCollection
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.dataset = (tuple(categories), tuple(values), tuple(widths))
+        layout = label_layout(values, widths)
+        centres = layout['centres']
+        colors = bar_colours(categories, values, widths)
+
+        # The plot area has a fixed size in inches; the figure is grown around it once
+        # the text outside it has been measured (see chart_margins)
+        self.axes_width, self.axes_height = axes_size(len(categories))
+        fig = self.fig = Figure(figsize=(self.axes_width, self.axes_height))
+        FigureCanvasAgg(fig)
+        ax = self.ax = fig.add_axes((0, 0, 1, 1))
+
+        ax.bar(layout['x_positions'], values, width=widths, color=colors, edgecolor='black', align='edge')
+
+        # Value labels on the x-axis: above it for positive bars, below it for negative ones
+        label_kw = dict(ha='center', rotation=90, fontsize=12)
+        for x, y, value, positive in zip(centres.tolist(), layout['value_y'].tolist(), values, layout['positive'].tolist()):
+            ax.text(x, y, f"{value}", va='bottom' if positive else 'top', **label_kw)
+
+        # All guide lines as a single collection instead of one vlines() call per bar
+        ax.add_collection(LineCollection(layout['segments'], colors='black', linestyles='dashed', linewidths=1),
+                          autolim=False)
+
+        ax.set_xticks(centres, categories, ha="center", rotation=90, fontsize=TICK_LABEL_SIZE)
+        ax.set_xlabel("CO2 Abatement, Million Tonne", fontsize=AXIS_LABEL_SIZE)
+        ax.set_ylabel("MACC Values USD/Ton CO2", fontsize=AXIS_LABEL_SIZE)
+        ax.tick_params(axis='y', labelsize=TICK_LABEL_SIZE)
+
+        # Add CO2 abatement values below the lines
+        for x, y, width in zip(centres.tolist(), layout['abatement_y'].tolist(), widths):
+            ax.text(x, y, f"{int(width)}", **label_kw)
+
+        # Add total abatement text just right of the last bar
+        total_label = f"Total: {layout['total_abatement']:.1f}"
+        ax.annotate(total_label, (layout['right_edge'], layout['total_y']), xytext=(6, 0),
+                    textcoords='offset points', ha='left', fontsize=12, color="black")
+        x_low, x_high = ax.get_xlim()
+        right_edge = (layout['right_edge'] - x_low) / (x_high - x_low) * self.axes_width * 72
+        self.total_overflow = right_edge + 6 + text_extent(total_label, 12)[0] - self.axes_width * 72
+
+        # The y range covers zero (bars start there, and the labels sit around it), so
+        # every data-positioned label stays inside the axes
+        self.layout = layout
+        self.y_range = (min(layout['y_min'], 0.0),
+                        max(layout['y_max'], float(layout['value_y'].max()) if len(values) else 0.0))
+        # Labels that start at a data y and run upwards a fixed number of points
+        self.raised = [(0.9, text_extent(f"{value}", 12)[0]) for value in values if value >= 0]
+        self.overlays = ()
+        self.line_value = None
+
+    def set_overlays(self, project_name, line_value=None):
+        ax = self.ax
+        layout = self.layout
+        small_offset = layout['small_offset']
+        for artist in self.overlays:
+            artist.remove()
+        self.overlays = ()
+        self.line_value = line_value
+
+        title = f"Marginal Abatement Cost Curve (MACC) - {project_name}"
+        ax.set_title(title, fontsize=TITLE_SIZE)
+
+        y_low, y_high = self.y_range
+        raised = list(self.raised)
+        # Add internal carbon price line if provided
+        if line_value is not None:
+            y_max = layout['y_max']
+            price_label_y = line_value + (y_max*0.02 if y_max>0 else 1)
+            price_label = f"Internal carbon price {line_value}"
+            line = ax.axhline(y=line_value, color='red', linestyle='--', linewidth=2)
+            # x in axes coordinates, so the label starts just inside the left edge at any scale
+            label = ax.text(0.01, price_label_y, price_label, color='black', fontsize=12,
+                            ha='left', transform=ax.get_yaxis_transform())
+            self.overlays = (line, label)
+            y_low = min(y_low, line_value)
+            y_high = max(y_high, price_label_y)
+            raised.append((price_label_y, text_extent(price_label, 12)[1]))
+
+        # The axes height in points is known, so grow the top of the range until the
+        # tallest upward-running label fits
+        bottom_lim = y_low - small_offset * 2
+        top_lim = y_high + small_offset
+        axes_height_pt = self.axes_height * 72
+        for y, extent in raised:
+            if extent < axes_height_pt:
+                top_lim = max(top_lim, bottom_lim + (y - bottom_lim) / (1 - extent / axes_height_pt))
+        ax.set_ylim(bottom_lim, top_lim)
+
+        # Size the margins from font metrics instead of a bbox_inches='tight' pre-draw
+        y_locs = [y for y in ax.yaxis.get_majorticklocs() if bottom_lim <= y <= top_lim]
+        formatter = ax.yaxis.get_major_formatter()
+        formatter.set_locs(y_locs)
+        ytick_labels = [formatter(y, i) for i, y in enumerate(y_locs)]
+        margins = chart_margins(ax, title, ytick_labels, self.dataset[0], self.total_overflow,
+                                self.axes_width * 72)
+        left, bottom, right, top = (m / 72 for m in margins)
+
+        fig_width = left + self.axes_width + right
+        fig_height = bottom + self.axes_height + top
+        self.fig.set_size_inches(fig_width, fig_height)
+        ax.set_position((left / fig_width, bottom / fig_height,
+                         self.axes_width / fig_width, self.axes_height / fig_height))
+
+
+def build_figure(project_name, categories, values, widths, line_value=None):
+    chart = ChartFigure(categories, values, widths)
+    chart.set_overlays(project_name, line_value)
+    return chart.fig
+
+
+# ---------------------------
+# Per-session figure reuse
+# ---------------------------
+# People often resubmit the same dataset with only a new title or carbon price.
+# Each render process keeps the last ChartFigure drawn for each session key, so
+# such a resubmission only swaps the overlays before encoding. The render pool
+# sends a session's jobs to the same worker for this (see RenderQueue). Figures
+# for large datasets are big, hence the small bound.
+
+FIGURE_CACHE_ENTRIES = int(os.environ.get('FIGURE_CACHE_ENTRIES', 16))
+_figures = LRUCache(max_entries=FIGURE_CACHE_ENTRIES)
+
+
+def session_figure(session_key, project_name, categories, values, widths, line_value=None):
+    """The ChartFigure for this spec, reusing ``session_key``'s last one when only
+    the overlays differ. Returns (chart, reused); hand the chart back with
+    ``keep_figure()`` once it has been saved."""
+    # Taken out of the cache while in use, so two threads never share a figure
+    chart = _figures.pop(session_key)
+    dataset = (tuple(categories), tuple(values), tuple(widths))
+    reused = chart is not None and chart.dataset == dataset
+    if not reused:
+        chart = ChartFigure(categories, values, widths)
+    chart.set_overlays(project_name, line_value)
+    return chart, reused
+
+
+def keep_figure(session_key, chart):
+    _figures.put(session_key, chart)
+
+
+CHART_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'pdf': 'application/pdf',
+}
+VECTOR_FORMATS = {'svg', 'pdf'}  # drawn without rasterising, so the profile doesn't change them
+
+
+def image_key(fmt, profile=DEFAULT_PROFILE):
+    """Name under which a rendered file is cached; vector files are the same at any profile."""
+    return fmt if fmt in VECTOR_FORMATS else f"{fmt}@{profile}"
+
+
+def check_options(fmt, profile):
+    if fmt not in CHART_FORMATS:
+        raise ValueError(f"Unsupported chart format: {fmt}")
+    if profile not in RENDER_PROFILES:
+        raise ValueError(f"Unknown render profile: {profile}")
+
+
+# ---------------------------
+# PNG encoders
+# ---------------------------
+# An encoder is a function (fig, dpi, out) that writes the figure to the file
+# object ``out`` as PNG. matplotlib's own writer uses zlib level 6, which spends
+# more time compressing than drawing for an interactive chart; a MACC chart is a
+# few dozen flat colours plus anti-aliased black text, so it also survives being
+# reduced to an 8-bit palette, at around a third of the size.
+#
+#     default  matplotlib's savefig as-is (zlib level 6, RGBA)
+#     fast     zlib level 1: quickest to encode, largest file
+#     palette  drawn once on the Agg canvas, quantised to 256 colours by Pillow
+#              and written with zlib level 9: slower, smallest file
+#
+# A profile picks its encoder (see RENDER_PROFILES); set PNG_ENCODER to use one
+# encoder for every profile. Add an entry to PNG_ENCODERS to plug in another.
+
+PALETTE_COLOURS = 256
+
+
+def _encode_png_default(fig, dpi, out):
+    fig.savefig(out, format='png', dpi=dpi)
+
+
+def _encode_png_fast(fig, dpi, out):
+    fig.savefig(out, format='png', dpi=dpi, pil_kwargs={'compress_level': 1})
+
+
+def _encode_png_palette(fig, dpi, out):
+    from PIL import Image
+
+    fig.dpi = dpi
+    fig.canvas.draw()
+    size = fig.canvas.get_width_height(physical=True)
+    image = Image.frombuffer('RGBA', size, fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1).convert('RGB')
+    # Fast octree is several times quicker than median cut and, with this few
+    # distinct colours, indistinguishable from it
+    image = image.quantize(PALETTE_COLOURS, method=Image.Quantize.FASTOCTREE)
+    image.save(out, format='PNG', compress_level=9)
+
+
+PNG_ENCODERS = {
+    'default': _encode_png_default,
+    'fast': _encode_png_fast,
+    'palette': _encode_png_palette,
+}
+PNG_ENCODER = os.environ.get('PNG_ENCODER') or None
+if PNG_ENCODER is not None and PNG_ENCODER not in PNG_ENCODERS:
+    raise ValueError(f"PNG_ENCODER must be one of {', '.join(PNG_ENCODERS)}, not {PNG_ENCODER!r}")
+
+
+def png_encoder(profile):
+    return PNG_ENCODER or RENDER_PROFILES[profile]['png_encoder']
+
+
+def save_chart(fig, out, fmt, profile):
+    """Write ``fig`` to ``out`` as ``fmt`` at ``profile``'s resolution."""
+    dpi = profile_dpi(profile, fig.get_size_inches())
+    if fmt == 'png':
+        PNG_ENCODERS[png_encoder(profile)](fig, dpi, out)
+    else:
+        fig.savefig(out, format=fmt, dpi=dpi)
+
+
+def render_chart(project_name, categories, values, widths, line_value=None, fmt='png', profile=DEFAULT_PROFILE,
+                 timings=None, session_key=None):
+    """Render the chart to ``fmt`` bytes at ``profile``'s resolution. If ``timings``
+    is a dict, the seconds spent building the figure and in savefig are stored under
+    'figure' (or 'figure_update', when a session's figure was reused) and 'savefig'.
+    With a ``session_key`` the figure is kept for that session's next render."""
+    check_options(fmt, profile)
+    started = time.perf_counter()
+    if session_key is None:
+        fig, chart, reused = build_figure(project_name, categories, values, widths, line_value), None, False
+    else:
+        chart, reused = session_figure(session_key, project_name, categories, values, widths, line_value)
+        fig = chart.fig
+    built = time.perf_counter()
+    buf = io.BytesIO()
+    save_chart(fig, buf, fmt, profile)
+    if chart is not None:
+        keep_figure(session_key, chart)
+    if timings is not None:
+        timings['figure_update' if reused else 'figure'] = built - started
+        timings['savefig'] = time.perf_counter() - built
+    return buf.getvalue()
+
@@ -0,0 +1,136 @@
+import os
+import time
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# ---------------------------
+# Latency histograms + Prometheus text exposition
+# ---------------------------
+# Counters live in the web process; render pool workers send their timings back
+# with each result. With several gunicorn workers per instance, each scrape of
+# /metrics only sees the worker that answered it.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus sense."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        # Buckets are upper bounds (le), so an observation equal to a bound counts in it
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def cumulative(self):
+        running = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            running += n
+            yield bound, running
+
+
+class HistogramFamily:
+    """Histograms keyed by one label value (e.g. stage or endpoint name)."""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = Histogram(self.buckets)
+            series.observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {'count': h.count, 'sum': h.total, 'buckets': list(h.cumulative())}
+                    for key, h in self._series.items()}
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.snapshot().items()):
+            label = f'{self.label}="{_escape(key)}"'
+            for bound, n in series['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{label},le="{le}"}} {n}')
+            lines.append(f"{self.name}_sum{{{label}}} {series['sum']}")
+            lines.append(f"{self.name}_count{{{label}}} {series['count']}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_lines(name, help_text, value, kind='gauge'):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+stage_seconds = HistogramFamily('macc_stage_duration_seconds',
+                                'Time spent in each stage of the chart pipeline.', 'stage')
+request_seconds = HistogramFamily('macc_request_duration_seconds',
+                                  'Time to produce a response, by Flask endpoint.', 'endpoint')
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block into the ``stage`` histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(stage, time.perf_counter() - started)
+
+
+# ---------------------------
+# On-demand request profiling
+# ---------------------------
+class RequestProfiler:
+    """cProfile (or pyinstrument, if installed and asked for) around one request;
+    ``stop()`` writes the result under ``directory`` and returns the file path."""
+
+    def __init__(self, directory, kind='cprofile'):
+        self.directory = directory
+        self.kind = kind
+        if kind == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise RuntimeError("pyinstrument is not installed on this server")
+            self._profiler = Profiler()
+        else:
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if self.kind == 'pyinstrument':
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        if self.kind == 'pyinstrument':
+            self._profiler.stop()
+            path = os.path.join(self.directory, f"{name}-{stamp}-{os.getpid()}.html")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self._profiler.output_html())
+        else:
+            self._profiler.disable()
+            path = os.path.join(self.directory, f"{name}-{stamp}-{os.getpid()}.prof")
+            self._profiler.dump_stats(path)
+        return path
@@ -1,3 +1,4 @@
 @echo off 
 flask db upgrade 
+flask bootstrap 
 flask run --host=0.0.0.0 --port=5000 
@@ -0,0 +1,269 @@
+import os
+import time
+import zlib
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from cache import LRUCache
+from metrics import stage_seconds
+from macc_renderer import DEFAULT_PROFILE, MATPLOTLIB_MODULES, render_chart
+
+# ---------------------------
+# Background chart rendering
+# ---------------------------
+# Web requests enqueue render jobs and return straight away; the work runs in a
+# process pool so a large chart never pins a gunicorn worker. JobStore is a local
+# stand-in for a broker (Redis/RabbitMQ): it only lives in this process, so job ids
+# are only valid on the worker that issued them.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobStore:
+    """Bounded in-memory job table; the oldest finished jobs fall out first."""
+
+    def __init__(self, max_jobs=1024):
+        self._jobs = LRUCache(max_entries=max_jobs)
+        self._lock = threading.Lock()
+
+    def create(self, owner, **fields):
+        job = {'id': uuid.uuid4().hex, 'owner': owner, 'status': QUEUED, 'error': None}
+        job.update(fields)
+        self._jobs.put(job['id'], job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+            return job
+
+
+def _warm_worker():
+    # Pool initializer: pay matplotlib's cold-start costs (font cache, Agg canvas,
+    # text layout caches) once per worker, before it takes real jobs.
+    started = time.perf_counter()
+    render_chart("warm-up", ["A", "B"], [1.0, -1.0], [1.0, 1.0], 0.5, fmt='png')
+    logging.debug(f"Render worker {os.getpid()} warmed in {time.perf_counter() - started:.2f}s")
+
+
+def _ping():
+    return os.getpid()
+
+
+def _render_timed(spec, fmt, profile, submitted_at, session_key=None):
+    # Runs in a pool worker; the timings travel back with the image so the web
+    # process can record them
+    timings = {'queue_wait': time.time() - submitted_at}
+    image = render_chart(*spec, fmt=fmt, profile=profile, timings=timings, session_key=session_key)
+    return image, timings
+
+
+def _record_timings(timings):
+    for stage, seconds in timings.items():
+        stage_seconds.observe(f"render_{stage}", seconds)
+
+
+class RenderQueue:
+    """Pre-warmed render workers plus job bookkeeping.
+
+    Workers come from a forkserver that has already imported matplotlib and the
+    renderer, and each one draws a throwaway chart before taking jobs. A worker is
+    replaced after ``max_tasks_per_worker`` renders to bound memory growth; that is
+    counted here rather than left to ``max_tasks_per_child``, which on Python 3.11
+    never starts a replacement while tasks are queued and so stalls the pool. The
+    workers are not created at import time so they are never forked before gunicorn
+    forks its own workers; call ``start()`` from a post-fork hook, or they start on
+    first use.
+
+    Each worker is its own single-process pool (a lane), so a job can be sent to a
+    particular worker: jobs with a session key go to that session's lane, where
+    its last figure is cached, unless that lane is more than ``affinity_slack``
+    jobs busier than the quietest one. Everything else goes to the quietest lane.
+    A lane whose worker died is replaced on its next submit. A lane with work
+    outstanding that has not finished anything for ``stall_timeout`` seconds is
+    treated as hung: its worker is killed, so its outstanding jobs fail (and
+    their on_failure handlers run) instead of waiting forever, and the lane is
+    replaced.
+    """
+
+    def __init__(self, max_workers=None, max_jobs=1024, max_tasks_per_worker=None, affinity_slack=1,
+                 stall_timeout=300):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_tasks_per_worker = max_tasks_per_worker or None
+        self.affinity_slack = affinity_slack
+        self.stall_timeout = stall_timeout
+        self.jobs = JobStore(max_jobs=max_jobs)
+        self._lanes = None
+        self._pending = [0] * self.max_workers
+        self._renders = [0] * self.max_workers  # renders submitted to each lane's current executor
+        self._progress = [0.0] * self.max_workers  # last time each lane took on or finished work
+        self._lock = threading.Lock()
+
+    def _new_lane(self):
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['render_jobs', *MATPLOTLIB_MODULES])
+        return ProcessPoolExecutor(max_workers=1, mp_context=ctx, initializer=_warm_worker)
+
+    def _pool(self):
+        with self._lock:
+            if self._lanes is None:
+                self._lanes = [self._new_lane() for _ in range(self.max_workers)]
+                logging.info(f"Render pool started with {self.max_workers} workers "
+                             f"(recycle after {self.max_tasks_per_worker or 'unlimited'} renders)")
+            return self._lanes
+
+    def _submit(self, session_key, fn, *args):
+        lanes = self._pool()
+        self._replace_stalled(lanes)
+        with self._lock:
+            lane = min(range(len(lanes)), key=self._pending.__getitem__)
+            if session_key is not None:
+                home = zlib.crc32(session_key.encode('utf-8')) % len(lanes)
+                if self._pending[home] <= self._pending[lane] + self.affinity_slack:
+                    lane = home
+            if self._pending[lane] == 0:
+                self._progress[lane] = time.monotonic()
+            self._pending[lane] += 1
+            executor = lanes[lane]
+            self._renders[lane] += 1
+            retire = self.max_tasks_per_worker is not None and self._renders[lane] >= self.max_tasks_per_worker
+        try:
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # The lane's worker died (e.g. OOM-killed) and a broken executor never
+                # recovers; replace it, or this session's jobs would keep failing
+                executor = self._replace_lane(lanes, lane, executor, "died")
+                future = executor.submit(fn, *args)
+        except Exception:
+            self._finished(lane)
+            raise
+        future.add_done_callback(lambda _: self._finished(lane))
+        if retire:
+            # This was the worker's last render: later jobs go to a fresh worker while
+            # the old one finishes what it has queued and exits
+            self._replace_lane(lanes, lane, executor, f"reached {self.max_tasks_per_worker} renders")
+        return future
+
+    def _replace_lane(self, lanes, lane, old, reason):
+        with self._lock:
+            replaced = lanes[lane] is old  # else a concurrent submit already did it
+            if replaced:
+                lanes[lane] = self._new_lane()
+                self._renders[lane] = 0
+                self._progress[lane] = time.monotonic()
+            replacement = lanes[lane]
+        if replaced:
+            logging.info(f"Render worker for lane {lane} {reason}; started a new one")
+            old.shutdown(wait=False)
+        return replacement
+
+    def _replace_stalled(self, lanes):
+        if not self.stall_timeout:
+            return
+        now = time.monotonic()
+        with self._lock:
+            stalled = [(lane, lanes[lane]) for lane in range(len(lanes))
+                       if self._pending[lane] and now - self._progress[lane] > self.stall_timeout]
+        for lane, executor in stalled:
+            logging.error(f"Render worker for lane {lane} made no progress in {self.stall_timeout}s")
+            # Killed before the swap, since shutdown() forgets the processes. The
+            # executor then fails everything it still holds with BrokenProcessPool.
+            for process in list((executor._processes or {}).values()):
+                process.kill()
+            self._replace_lane(lanes, lane, executor, "stalled")
+
+    def _finished(self, lane):
+        with self._lock:
+            self._pending[lane] -= 1
+            self._progress[lane] = time.monotonic()
+
+    def start(self, timeout=60):
+        """Create the workers and make sure every one is spawned and warmed."""
+        # Each worker runs the warm-up initializer before its first task, so
+        # waiting on one ping per worker means the whole pool is warm. Pings don't
+        # count towards max_tasks_per_worker, which only counts renders.
+        wait([lane.submit(_ping) for lane in self._pool()], timeout=timeout)
+
+    def submit(self, owner, spec, fmt='png', profile=DEFAULT_PROFILE, on_success=None, on_failure=None,
+               session_key=None, **fields):
+        """Queue a render of ``spec`` (the positional args of render_chart).
+
+        ``on_success(job, image_bytes)`` runs in the pool's callback thread once the
+        image is ready; if it raises, the job is marked failed. ``on_failure(job,
+        exception)`` runs when the job fails for any reason. With a ``session_key``
+        the worker reuses that session's last figure if only its title or carbon
+        price line changed.
+        """
+        job = self.jobs.create(owner, spec=spec, fmt=fmt, profile=profile, **fields)
+        future = self._submit(session_key, _render_timed, spec, fmt, profile, time.time(), session_key)
+        job['future'] = future
+
+        def _finished(fut):
+            try:
+                image, timings = fut.result()
+                _record_timings(timings)
+                if on_success is not None:
+                    on_success(job, image)
+            except (Exception, CancelledError) as e:
+                logging.error(f"Render job {job['id']} failed: {e}")
+                self.jobs.update(job['id'], status=FAILED, error=str(e))
+                if on_failure is not None:
+                    try:
+                        on_failure(job, e)
+                    except Exception as cb_error:
+                        logging.error(f"Failure handler for render job {job['id']} raised: {cb_error}")
+            else:
+                self.jobs.update(job['id'], status=DONE)
+
+        future.add_done_callback(_finished)
+        return job
+
+    def render_many(self, specs, fmt='png', profile=DEFAULT_PROFILE):
+        """Render every spec across the pool, yielding (index, image bytes or the
+        exception raised) in completion order rather than submission order.
+
+        Renders that haven't started are cancelled if the caller stops early.
+        """
+        submitted_at = time.time()
+        futures = {self._submit(None, _render_timed, spec, fmt, profile, submitted_at): i
+                   for i, spec in enumerate(specs)}
+        try:
+            for future in as_completed(futures):
+                try:
+                    image, timings = future.result()
+                except (Exception, CancelledError) as e:
+                    yield futures[future], e
+                else:
+                    _record_timings(timings)
+                    yield futures[future], image
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def status(self, job):
+        if self._lanes is not None:
+            self._replace_stalled(self._lanes)
+        if job['status'] == QUEUED and job.get('future') is not None and job['future'].running():
+            return RUNNING
+        return job['status']
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            lanes, self._lanes = self._lanes, None
+            self._pending = [0] * self.max_workers
+            self._renders = [0] * self.max_workers
+        for lane in lanes or ():
+            lane.shutdown(wait=wait)
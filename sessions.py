@@ -0,0 +1,168 @@
+import secrets
+import threading
+from datetime import datetime, timedelta, timezone
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from sqlalchemy import delete, insert, select
+
+from cache import TTLCache
+
+# ---------------------------
+# Server-side sessions
+# ---------------------------
+# With a server-side store the session cookie only carries a random id, so it stays
+# small and requests skip the HMAC check and deserialisation of a signed cookie.
+# Stores implement get(sid) -> dict or None, set(sid, data) and delete(sid):
+#
+#     MemorySessionStore  in-process LRU; single node / single gunicorn worker only
+#     SQLSessionStore     a table in the app's database; shared by every worker
+#     RedisSessionStore   a Redis server (needs the optional `redis` package)
+
+SID_BYTES = 32
+MAX_SID_LENGTH = 64
+
+serializer = TaggedJSONSerializer()
+
+
+class MemorySessionStore:
+    def __init__(self, ttl, max_entries=10000):
+        self._sessions = TTLCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, sid):
+        data = self._sessions.get(sid)
+        # Hand out a copy so an unsaved request never changes the stored session
+        return dict(data) if data is not None else None
+
+    def set(self, sid, data):
+        self._sessions.put(sid, dict(data))
+
+    def delete(self, sid):
+        self._sessions.pop(sid)
+
+
+class SQLSessionStore:
+    """Sessions as rows of ``table`` (sid, data, expires_at), written in their own
+    transaction so they never get mixed up with the request's ORM session."""
+
+    PURGE_EVERY = 1000  # writes between sweeps of expired rows
+
+    def __init__(self, engine, table, ttl):
+        self._engine = engine  # a callable, so the engine can be created lazily
+        self._table = table
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def get(self, sid):
+        table = self._table
+        with self._engine().connect() as conn:
+            data = conn.execute(
+                select(table.c.data).where(table.c.sid == sid, table.c.expires_at > self._now())
+            ).scalar()
+        return serializer.loads(data) if data is not None else None
+
+    def set(self, sid, data):
+        table = self._table
+        now = self._now()
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        with self._engine().begin() as conn:
+            conn.execute(delete(table).where(table.c.sid == sid))
+            conn.execute(insert(table).values(sid=sid, data=serializer.dumps(data),
+                                              expires_at=now + timedelta(seconds=self.ttl)))
+            if purge:
+                conn.execute(delete(table).where(table.c.expires_at <= now))
+
+    def delete(self, sid):
+        with self._engine().begin() as conn:
+            conn.execute(delete(self._table).where(self._table.c.sid == sid))
+
+
+class RedisSessionStore:
+    def __init__(self, url, ttl, prefix='session:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_BACKEND=redis needs the 'redis' package (pip install redis)")
+        self._client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self._prefix = prefix
+
+    def get(self, sid):
+        data = self._client.get(self._prefix + sid)
+        return serializer.loads(data) if data is not None else None
+
+    def set(self, sid, data):
+        self._client.setex(self._prefix + sid, self.ttl, serializer.dumps(data))
+
+    def delete(self, sid):
+        self._client.delete(self._prefix + sid)
+
+
+class ServerSession(SecureCookieSession):
+    """Session dict with the id it is stored under (None until first saved).
+
+    Reuses SecureCookieSession for its modified/accessed tracking.
+    """
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.rotate = False
+
+    def regenerate(self):
+        # Issue a new id on the next save (e.g. at login) so an id planted before
+        # authentication can't be reused afterwards
+        self.rotate = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and len(sid) <= MAX_SID_LENGTH:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSession(data, sid)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        cookie = dict(
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            partitioned=self.get_cookie_partitioned(app),
+            samesite=self.get_cookie_samesite(app),
+            httponly=self.get_cookie_httponly(app),
+        )
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            if session.modified and session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, **cookie)
+                response.vary.add("Cookie")
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        if session.modified or session.sid is None:
+            if session.rotate and session.sid is not None:
+                self.store.delete(session.sid)
+            if session.rotate or session.sid is None:
+                session.sid = secrets.token_urlsafe(SID_BYTES)
+            self.store.set(session.sid, dict(session))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), **cookie)
+        response.vary.add("Cookie")